@@ -1,10 +1,12 @@
 import argparse
+import copy
 import os
 import random
 import shutil
 import time
 import warnings
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.parallel
@@ -18,6 +20,8 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 
+import shards
+
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
     and callable(models.__dict__[name]))
@@ -73,6 +77,28 @@ parser.add_argument('--multiprocessing-distributed', action='store_true',
                          'N processes per node, which has N GPUs. This is the '
                          'fastest way to use PyTorch for either single node or '
                          'multi node data parallel training')
+parser.add_argument('--shards', action='store_true',
+                    help='read train and val from shard files written by '
+                         'pack_shards.py instead of image folders')
+parser.add_argument('--shuffle-buffer', default=1024, type=int, metavar='N',
+                    help='number of images each loader worker shuffles within '
+                         'when streaming training shards (default: 1024)')
+parser.add_argument('--uint8-loader', action='store_true',
+                    help='load uint8 images and convert and normalize whole '
+                         'batches on the training device')
+parser.add_argument('--channels-last', action='store_true',
+                    help='use the channels_last memory format for the model '
+                         'and its inputs')
+parser.add_argument('--cpu-perf', action='store_true',
+                    help='when training on CPU, use channels_last and, where '
+                         'the CPU supports it, bfloat16 autocast with fp32 '
+                         'weights')
+parser.add_argument('--compare-fp32', action='store_true',
+                    help='with --cpu-perf and -e, also validate with the fp32 '
+                         'NCHW path and report the accuracy delta and speedup')
+parser.add_argument('--loader-stats', action='store_true',
+                    help='report the bytes per image passed from the loader '
+                         'workers and their CPU time per image')
 
 best_acc1 = 0
 
@@ -128,6 +154,11 @@ def main_worker(gpu, ngpus_per_node, args):
             args.rank = args.rank * ngpus_per_node + gpu
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
+    args.bf16 = False
+    if not torch.cuda.is_available() and args.cpu_perf:
+        args.channels_last = True
+        args.bf16 = cpu_bf16_supported()
+
     # create model
     if args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
@@ -136,8 +167,17 @@ def main_worker(gpu, ngpus_per_node, args):
         print("=> creating model '{}'".format(args.arch))
         model = models.__dict__[args.arch]()
 
+    if args.channels_last:
+        # Converted before DistributedDataParallel builds its gradient buckets
+        # from the parameter strides and before DataParallel replicates it.
+        model = model.to(memory_format=torch.channels_last)
+
     if not torch.cuda.is_available():
-        print('using CPU, this will be slow')
+        if args.cpu_perf:
+            print('using CPU with channels_last and {} autocast'.format(
+                'bfloat16' if args.bf16 else 'no (this CPU has no bfloat16 support)'))
+        else:
+            print('using CPU, this will be slow')
     elif args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
@@ -185,10 +225,8 @@ def main_worker(gpu, ngpus_per_node, args):
                 loc = 'cuda:{}'.format(args.gpu)
                 checkpoint = torch.load(args.resume, map_location=loc)
             args.start_epoch = checkpoint['epoch']
-            best_acc1 = checkpoint['best_acc1']
-            if args.gpu is not None:
-                # best_acc1 may be from a checkpoint from a different GPU
-                best_acc1 = best_acc1.to(args.gpu)
+            # Older checkpoints hold best_acc1 as a tensor, possibly on another GPU.
+            best_acc1 = float(checkpoint['best_acc1'])
             model.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
             print("=> loaded checkpoint '{}' (epoch {})"
@@ -201,43 +239,72 @@ def main_worker(gpu, ngpus_per_node, args):
     # Data loading code
     traindir = os.path.join(args.data, 'train')
     valdir = os.path.join(args.data, 'val')
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
-
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose([
-            transforms.RandomResizedCrop(224),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ]))
+    mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    if args.uint8_loader:
+        # The workers only crop; a batch is converted to float and normalized on the device.
+        to_tensor = [ToUint8()]
+        device = torch.device('cuda', args.gpu) if args.gpu is not None else \
+            torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        normalizer = BatchNormalize(mean, std, device)
+    else:
+        to_tensor = [transforms.ToTensor(), transforms.Normalize(mean=mean, std=std)]
+        normalizer = None
+
+    train_transform = transforms.Compose([
+        transforms.RandomResizedCrop(224),
+        transforms.RandomHorizontalFlip(),
+    ] + to_tensor)
+    val_transform = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+    ] + to_tensor)
+
+    if args.shards:
+        # Training streams whole shards, which are already split across the ranks
+        # and shuffled every epoch, so it needs no sampler.
+        train_dataset = shards.ShardedIterableDataset(
+            traindir, train_transform, buffer_size=args.shuffle_buffer, batch_size=args.batch_size,
+            num_replicas=args.world_size if args.distributed else 1,
+            rank=args.rank if args.distributed else 0)
+        val_dataset = shards.ShardedImageDataset(valdir, val_transform)
+    else:
+        train_dataset = datasets.ImageFolder(traindir, train_transform)
+        val_dataset = datasets.ImageFolder(valdir, val_transform)
 
-    if args.distributed:
+    if args.distributed and not args.shards:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
     else:
         train_sampler = None
 
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None and not args.shards),
         num_workers=args.workers, pin_memory=True, sampler=train_sampler)
 
+    if args.distributed:
+        # Every rank validates its own share and the metrics are all-reduced.
+        val_sampler = DistributedEvalSampler(val_dataset)
+    else:
+        val_sampler = None
+
     val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
+        val_dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=args.workers, pin_memory=True, sampler=val_sampler)
+
+    if normalizer is not None or args.loader_stats:
+        train_loader = PreparedLoader(train_loader, normalizer, args.loader_stats)
+        val_loader = PreparedLoader(val_loader, normalizer, args.loader_stats)
 
     if args.evaluate:
-        validate(val_loader, model, criterion, args)
+        if args.compare_fp32 and args.cpu_perf:
+            compare_fp32(val_loader, model, criterion, args)
+        else:
+            validate(val_loader, model, criterion, args)
         return
 
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if args.shards:
+            train_dataset.set_epoch(epoch)
+        elif args.distributed:
             train_sampler.set_epoch(epoch)
         adjust_learning_rate(optimizer, epoch, args)
 
@@ -247,7 +314,8 @@ def main_worker(gpu, ngpus_per_node, args):
         # evaluate on validation set
         acc1 = validate(val_loader, model, criterion, args)
 
-        # remember best acc@1 and save checkpoint
+        # remember best acc@1 and save checkpoint; in distributed runs acc1 is
+        # all-reduced over the whole validation set, so every rank agrees on it
         is_best = acc1 > best_acc1
         best_acc1 = max(acc1, best_acc1)
 
@@ -272,11 +340,12 @@ def train(train_loader, model, criterion, optimizer, epoch, args):
         len(train_loader),
         [batch_time, data_time, losses, top1, top5],
         prefix="Epoch: [{}]".format(epoch))
+    metrics = MetricAccumulator([losses, top1, top5], args.distributed, len(train_loader))
 
     # switch to train mode
     model.train()
 
-    end = time.time()
+    start = end = time.time()
     for i, (images, target) in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
@@ -285,16 +354,17 @@ def train(train_loader, model, criterion, optimizer, epoch, args):
             images = images.cuda(args.gpu, non_blocking=True)
         if torch.cuda.is_available():
             target = target.cuda(args.gpu, non_blocking=True)
+        images = images.contiguous(memory_format=memory_format(args))
 
-        # compute output
-        output = model(images)
-        loss = criterion(output, target)
+        # compute output; under bfloat16 autocast the weights and their
+        # gradients stay in fp32 and only the activations are bfloat16
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(images)
+            loss = criterion(output, target)
 
-        # measure accuracy and record loss
+        # measure accuracy and record loss, without waiting for the device
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), images.size(0))
-        top1.update(acc1[0], images.size(0))
-        top5.update(acc5[0], images.size(0))
+        metrics.update(images.size(0), loss, acc1[0], acc5[0])
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -306,8 +376,12 @@ def train(train_loader, model, criterion, optimizer, epoch, args):
         end = time.time()
 
         if i % args.print_freq == 0:
+            metrics.synchronize(final=False)
             progress.display(i)
 
+    metrics.synchronize()
+    print(' * Train: {:.1f} images/sec'.format(metrics.local_count / (time.time() - start)))
+
 
 def validate(val_loader, model, criterion, args):
     batch_time = AverageMeter('Time', ':6.3f')
@@ -318,42 +392,87 @@ def validate(val_loader, model, criterion, args):
         len(val_loader),
         [batch_time, losses, top1, top5],
         prefix='Test: ')
+    metrics = MetricAccumulator([losses, top1, top5], args.distributed, len(val_loader))
+
+    # The padding that gives all ranks the same number of batches is left out.
+    num_valid = getattr(val_loader.sampler, 'num_valid', None)
+    seen = 0
 
     # switch to evaluate mode
     model.eval()
 
     with torch.no_grad():
-        end = time.time()
+        start = end = time.time()
         for i, (images, target) in enumerate(val_loader):
             if args.gpu is not None:
                 images = images.cuda(args.gpu, non_blocking=True)
             if torch.cuda.is_available():
                 target = target.cuda(args.gpu, non_blocking=True)
+            images = images.contiguous(memory_format=memory_format(args))
 
-            # compute output
-            output = model(images)
-            loss = criterion(output, target)
+            n = images.size(0)
+            if num_valid is not None:
+                n = max(0, min(n, num_valid - seen))
+                seen += images.size(0)
 
-            # measure accuracy and record loss
+            # compute output
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=args.bf16):
+                output = model(images)
+                if n:
+                    output, target = output[:n], target[:n]
+                # A batch of padding only is still measured, with weight 0, so that
+                # all ranks take part in the same all-reduces.
+                loss = criterion(output, target)
+
+            # measure accuracy and record loss, without waiting for the device
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), images.size(0))
-            top1.update(acc1[0], images.size(0))
-            top5.update(acc5[0], images.size(0))
+            metrics.update(n, loss, acc1[0], acc5[0])
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
             if i % args.print_freq == 0:
+                metrics.synchronize(final=False)
                 progress.display(i)
 
+        metrics.synchronize()
         # TODO: this should also be done with the ProgressMeter
-        print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
-              .format(top1=top1, top5=top5))
+        print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f} ({images_per_sec:.1f} images/sec)'
+              .format(top1=top1, top5=top5, images_per_sec=metrics.local_count / (time.time() - start)))
 
     return top1.avg
 
 
+def compare_fp32(val_loader, model, criterion, args):
+    """Validates with the plain fp32 NCHW path and with --cpu-perf, and reports
+    the change in accuracy and throughput."""
+    fp32_args = copy.copy(args)
+    fp32_args.channels_last, fp32_args.bf16 = False, False
+    results = []
+    for run_args in (fp32_args, args):
+        model.to(memory_format=memory_format(run_args))
+        start = time.time()
+        acc1 = validate(val_loader, model, criterion, run_args)
+        results.append((float(acc1), time.time() - start))
+    (fp32_acc1, fp32_time), (perf_acc1, perf_time) = results
+    print(' * fp32 Acc@1 {:.3f} | {} Acc@1 {:.3f} | delta {:+.3f} | speedup {:.2f}x'.format(
+        fp32_acc1, 'bf16' if args.bf16 else 'channels_last', perf_acc1, perf_acc1 - fp32_acc1,
+        fp32_time / perf_time))
+
+
+def memory_format(args):
+    return torch.channels_last if args.channels_last else torch.contiguous_format
+
+
+def cpu_bf16_supported():
+    """Whether oneDNN has bfloat16 kernels for this CPU (AVX512 with BF16 or AMX)."""
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
     torch.save(state, filename)
     if is_best:
@@ -384,6 +503,83 @@ class AverageMeter(object):
         return fmtstr.format(**self.__dict__)
 
 
+class DistributedEvalSampler(torch.utils.data.Sampler):
+    """Splits a dataset across ranks in order, without shuffling, for validation.
+
+    Rank r takes samples r, r + num_replicas, ... Like DistributedSampler,
+    every rank yields ceil(len / num_replicas) indices, so all ranks run the
+    same number of batches; ranks that fall one short repeat their first
+    sample. Only the first `num_valid` indices of a rank are real, so every
+    sample is counted exactly once when the metrics are all-reduced.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.total_size = len(dataset)
+        self.num_samples = (self.total_size + self.num_replicas - 1) // self.num_replicas
+        self.num_valid = len(range(self.rank, self.total_size, self.num_replicas))
+
+    def __iter__(self):
+        indices = list(range(self.rank, self.total_size, self.num_replicas))
+        return iter(indices + indices[:self.num_samples - self.num_valid])
+
+    def __len__(self):
+        return self.num_samples
+
+
+class MetricAccumulator(object):
+    """Accumulates per-batch metrics on their device and fills AverageMeters from them.
+
+    `update` only adds the batch's values, weighted by its size, to running
+    sums on the device, so it never waits for the device the way .item() does.
+    The sums are float64: over an epoch the Acc@1 sum exceeds 2^24, from where
+    float32 additions round.
+    `synchronize` copies the sums to the host in one transfer and sets `val`
+    (the last batch) and `avg` (the whole pass) of every meter. With
+    `distributed`, the sums and counts are first all-reduced, so the meters show
+    the metrics of the global batch. The all-reduce needs every rank to call it
+    at the same steps, so `steps`, the number of batches of this rank, is
+    compared across ranks once: if they differ, `synchronize(final=False)`
+    shows the metrics of this rank only and just the final call all-reduces.
+    """
+
+    def __init__(self, meters, distributed=False, steps=None):
+        self.meters = meters
+        self.distributed = distributed
+        self.equal_steps = True
+        if distributed:
+            all_steps = [None] * dist.get_world_size()
+            dist.all_gather_object(all_steps, steps)
+            self.equal_steps = len(set(all_steps)) == 1
+        self.total = None
+        self.last = None
+        self.local_count = 0
+        self.last_count = 0
+
+    def update(self, n, *values):
+        self.last = torch.stack([v.detach().double().reshape(()) for v in values]) * n
+        self.total = self.last.clone() if self.total is None else self.total.add_(self.last)
+        self.local_count += n
+        self.last_count = n
+
+    def synchronize(self, final=True):
+        if self.total is None:
+            return
+        # Counts are known on the host; they join the sums only for the all-reduce.
+        counts = self.total.new_tensor([self.local_count, self.last_count])
+        sums = torch.cat([self.total, self.last, counts])
+        if self.distributed and (final or self.equal_steps):
+            dist.all_reduce(sums)
+        sums = sums.tolist()
+        k = len(self.meters)
+        count, last_count = sums[2 * k:]
+        for meter, total, last in zip(self.meters, sums[:k], sums[k:2 * k]):
+            meter.sum, meter.count = total, count
+            meter.avg = total / count
+            meter.val = last / last_count
+
+
 class ProgressMeter(object):
     def __init__(self, num_batches, meters, prefix=""):
         self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
@@ -401,6 +597,71 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
+class ToUint8(object):
+    """Converts a PIL image to an HWC uint8 tensor, a quarter of the size of the float
+    tensor of ToTensor, which is what the loader workers pass to the main process."""
+
+    def __call__(self, pic):
+        return torch.from_numpy(np.array(pic, dtype=np.uint8, copy=True))
+
+
+class BatchNormalize(object):
+    """Moves an NHWC uint8 batch to `device`, converts it to float NCHW and normalizes it."""
+
+    def __init__(self, mean, std, device):
+        # Images stay in [0, 255], so the statistics are scaled instead.
+        self.mean = torch.tensor(mean, device=device).mul(255).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=device).mul(255).view(1, -1, 1, 1)
+        self.device = device
+
+    def __call__(self, images):
+        images = images.to(self.device, non_blocking=True).permute(0, 3, 1, 2)
+        # The permuted NHWC batch already has the strides of channels_last, which
+        # float() preserves, so a channels_last model needs no further copy.
+        return images.float().sub_(self.mean).div_(self.std)
+
+
+class PreparedLoader(object):
+    """Wraps a DataLoader to normalize each batch of images before it is used.
+
+    With `stats`, it prints the bytes per image of the batches the workers
+    produced and the CPU time the workers spent per image once the loader is
+    exhausted; the workers' CPU time is counted when they exit at the end of
+    every pass, so it is only available with -j > 0. The statistics use the
+    resource module, which Windows does not have.
+    """
+
+    def __init__(self, loader, normalizer=None, stats=False):
+        self.loader = loader
+        self.normalizer = normalizer
+        self.stats = stats
+        if stats:
+            import resource
+            self._children_usage = lambda: resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __iter__(self):
+        images_seen, nbytes = 0, 0
+        start = self._children_usage() if self.stats else None
+        for images, target in self.loader:
+            images_seen += images.size(0)
+            nbytes += images.numel() * images.element_size()
+            if self.normalizer is not None:
+                images = self.normalizer(images)
+            yield images, target
+        if self.stats and images_seen:
+            end = self._children_usage()
+            cpu = end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime
+            print(' * Loader: {:.0f} bytes/image to the main process, {:.2f} ms worker CPU/image'
+                  .format(nbytes / images_seen, cpu * 1000 / images_seen))
+
+
 def adjust_learning_rate(optimizer, epoch, args):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
     lr = args.lr * (0.1 ** (epoch // 30))
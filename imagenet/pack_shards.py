@@ -0,0 +1,35 @@
+import argparse
+import random
+
+import torchvision.datasets as datasets
+
+import shards
+
+parser = argparse.ArgumentParser(description='Pack an ImageFolder split into shard files for main.py --shards')
+parser.add_argument('src', metavar='SRC',
+                    help='ImageFolder directory with one subfolder per class, e.g. imagenet/train')
+parser.add_argument('dst', metavar='DST',
+                    help='output directory for the shards and their index')
+parser.add_argument('--shard-size', default=1024, type=int, metavar='MB',
+                    help='approximate size of each shard file in MiB (default: 1024)')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed for the order of the images across shards')
+parser.add_argument('--no-shuffle', dest='shuffle', action='store_false',
+                    help='keep the class-sorted order of ImageFolder instead of mixing classes across shards')
+
+
+def main():
+    args = parser.parse_args()
+    # Only lists the files; the images are copied as they are, without decoding.
+    folder = datasets.ImageFolder(args.src)
+    samples = list(folder.samples)
+    if args.shuffle:
+        # Shards are shuffled as units when training, so each one should hold a mix of classes.
+        random.Random(args.seed).shuffle(samples)
+    shards.write_shards(samples, folder.classes, args.dst, args.shard_size << 20)
+    print("=> packed {} images of {} classes from '{}' into '{}'".format(
+        len(samples), len(folder.classes), args.src, args.dst))
+
+
+if __name__ == '__main__':
+    main()
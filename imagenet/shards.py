@@ -0,0 +1,236 @@
+import io
+import json
+import math
+import os
+import random
+from array import array
+
+import torch
+import torch.distributed as dist
+import torch.utils.data
+from PIL import Image
+
+INDEX = 'index.json'
+
+
+def write_shards(samples, classes, root, shard_bytes=1 << 30):
+    """Packs the (path, class index) pairs of `samples` into shard files under `root`.
+
+    Each shard is the concatenation of the encoded image files, in order, and
+    has an .idx file with the (offset, length, target) of every image as int64.
+    `index.json` lists the classes and the shards and is written last, so an
+    interrupted conversion is not mistaken for a complete one.
+    """
+    os.makedirs(root, exist_ok=True)
+    shards = []
+    f, entries = None, None
+
+    def close_shard():
+        f.close()
+        with open(os.path.join(root, shards[-1]['index']), 'wb') as idx:
+            entries.tofile(idx)
+        shards[-1]['samples'] = len(entries) // 3
+
+    for path, target in samples:
+        if f is None or f.tell() >= shard_bytes:
+            if f is not None:
+                close_shard()
+            name = 'shard-{:05d}'.format(len(shards))
+            shards.append({'file': name + '.bin', 'index': name + '.idx'})
+            f, entries = open(os.path.join(root, name + '.bin'), 'wb'), array('q')
+        with open(path, 'rb') as image:
+            data = image.read()
+        entries.extend((f.tell(), len(data), target))
+        f.write(data)
+    if f is not None:
+        close_shard()
+    with open(os.path.join(root, INDEX), 'w') as index:
+        json.dump({'classes': classes, 'samples': sum(s['samples'] for s in shards), 'shards': shards}, index)
+
+
+def _read_index(root):
+    with open(os.path.join(root, INDEX)) as f:
+        index = json.load(f)
+    for shard in index['shards']:
+        entries = array('q')
+        with open(os.path.join(root, shard['index']), 'rb') as f:
+            entries.fromfile(f, 3 * shard['samples'])
+        shard['entries'] = entries
+    return index
+
+
+def _decode(data):
+    # Same conversion as the default loader of datasets.ImageFolder.
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+
+def _distributed_defaults(num_replicas, rank):
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    if rank is None:
+        rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    return num_replicas, rank
+
+
+class ShardedImageDataset(torch.utils.data.Dataset):
+    """Random-access view of shards written by `write_shards`, a drop-in for datasets.ImageFolder.
+
+    It has the same `classes`, `class_to_idx` and `targets` and works with any
+    sampler, including DistributedSampler. Every read is a seek into a shard,
+    so it suits validation; training should stream the shards with
+    ShardedIterableDataset.
+    """
+
+    def __init__(self, root, transform=None, target_transform=None):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        index = _read_index(root)
+        self.classes = index['classes']
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.files = [shard['file'] for shard in index['shards']]
+        self.locations = []
+        self.targets = []
+        for i, shard in enumerate(index['shards']):
+            entries = shard['entries']
+            for j in range(0, len(entries), 3):
+                self.locations.append((i, entries[j], entries[j + 1]))
+                self.targets.append(entries[j + 2])
+        self._handles = {}
+
+    def __getstate__(self):
+        # Open files are not passed to the DataLoader workers; each opens its own.
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        shard, offset, length = self.locations[index]
+        if shard not in self._handles:
+            self._handles[shard] = open(os.path.join(self.root, self.files[shard]), 'rb')
+        f = self._handles[shard]
+        f.seek(offset)
+        sample = _decode(f.read(length))
+        target = self.targets[index]
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+
+class ShardedIterableDataset(torch.utils.data.IterableDataset):
+    """Streams the shards written by `write_shards` with sequential reads.
+
+    Every epoch the shard order is shuffled with the same seed on all ranks,
+    like DistributedSampler, and rank r takes shards r, r + num_replicas, ...;
+    within a rank the DataLoader workers split the shards the same way. Images
+    pass through a shuffle buffer of `buffer_size` samples. Each rank yields
+    exactly ceil(len / num_replicas) samples, stopping early or going round its
+    shards again; with many shards per rank few images are skipped or repeated.
+    Each DataLoader worker batches its own samples, so `batch_size` has to be
+    the one of the DataLoader: every worker then yields whole batches except
+    one, and all ranks run ceil(num_samples / batch_size) batches, which
+    DistributedDataParallel requires. Call `set_epoch` before each epoch, as
+    with DistributedSampler.
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, num_replicas=None, rank=None,
+                 shuffle=True, seed=0, buffer_size=1024, batch_size=1):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        self.num_replicas, self.rank = _distributed_defaults(num_replicas, rank)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.buffer_size = buffer_size if shuffle else 0
+        self.batch_size = batch_size
+        self.epoch = 0
+        index = _read_index(root)
+        self.classes = index['classes']
+        self.shards = index['shards']
+        if len(self.shards) < self.num_replicas:
+            raise ValueError('{} has {} shards, fewer than the {} ranks'.format(
+                root, len(self.shards), self.num_replicas))
+        self.num_samples = math.ceil(index['samples'] / self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def _assigned_shards(self):
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        shards = order[self.rank::self.num_replicas]
+        worker = torch.utils.data.get_worker_info()
+        if worker is None:
+            return shards, self.num_samples, 0
+        # Each worker reads its own shards. Workers beyond the number of shards
+        # yield nothing.
+        readers = min(worker.num_workers, len(shards))
+        if worker.id >= readers:
+            return [], 0, worker.id
+        return shards[worker.id::readers], self._worker_quotas(shards, readers)[worker.id], worker.id
+
+    def _worker_quotas(self, shards, readers):
+        """Splits num_samples over `readers` workers in whole batches, close to the images each one reads.
+
+        The last, partial batch goes to the first worker, so the workers yield
+        ceil(num_samples / batch_size) batches together.
+        """
+        images = [sum(self.shards[i]['samples'] for i in shards[w::readers]) for w in range(readers)]
+        batches = [n // self.batch_size for n in images]
+        full, rest = divmod(self.num_samples, self.batch_size)
+        for k in range(full - sum(batches)):
+            batches[k % readers] += 1
+        for _ in range(sum(batches) - full):
+            batches[batches.index(max(batches))] -= 1
+        quotas = [n * self.batch_size for n in batches]
+        quotas[0] += rest
+        return quotas
+
+    def _images(self, shards, quota):
+        """Yields (encoded image, target) from `shards` in order, cycling until `quota` are read."""
+        count = 0
+        while shards and count < quota:
+            for i in shards:
+                shard = self.shards[i]
+                entries = shard['entries']
+                with open(os.path.join(self.root, shard['file']), 'rb') as f:
+                    # The images of a shard are contiguous, so reading them in order never seeks.
+                    for j in range(0, len(entries), 3):
+                        yield f.read(entries[j + 1]), entries[j + 2]
+                        count += 1
+                        if count == quota:
+                            return
+
+    def __iter__(self):
+        shards, quota, worker_id = self._assigned_shards()
+        rng = random.Random((self.seed + self.epoch) * 100003 + self.rank * 1009 + worker_id)
+        buffer = []
+        for item in self._images(shards, quota):
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            # Emit a random buffered image and keep the new one in its place.
+            j = rng.randrange(len(buffer))
+            buffer[j], item = item, buffer[j]
+            yield self._load(item)
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield self._load(item)
+
+    def _load(self, item):
+        data, target = item
+        sample = _decode(data)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
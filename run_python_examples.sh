@@ -144,6 +144,8 @@ function vae() {
 function word_language_model() {
   start
   python main.py --epochs 1 --dry-run $CUDA_FLAG || error "word_language_model failed"
+  torchrun --nproc_per_node=2 main.py --epochs 1 --dry-run --distributed || error "distributed word_language_model failed"
+  torchrun --nproc_per_node=2 main.py --epochs 1 --dry-run --distributed --vocab-parallel || error "vocab-parallel word_language_model failed"
 }
 
 function clean() {
@@ -0,0 +1,289 @@
+###############################################################################
+# Language model throughput benchmark
+#
+# Sweeps model type, decoder, sizes, sequence length, batch size and thread
+# count on a synthetic corpus and reports training, evaluation and generation tokens/sec
+# and peak memory as JSON. Every configuration runs in its own process, so
+# that its peak memory is not that of an earlier one. With --baseline, the
+# results are compared against an earlier run and the script fails if any of
+# them regressed.
+#
+###############################################################################
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+import model
+import profiling
+import sampling
+
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+
+parser = argparse.ArgumentParser(description='PyTorch word language model throughput benchmark')
+parser.add_argument('--models', type=str, default='LSTM,Transformer',
+                    help='comma-separated model types (RNN_TANH, RNN_RELU, LSTM, GRU, Transformer)')
+parser.add_argument('--decoders', type=str, default='full',
+                    help='comma-separated output layers: full (softmax) and/or adaptive (clustered adaptive softmax)')
+parser.add_argument('--sizes', type=int_list, default=[200],
+                    help='comma-separated sizes used for both --emsize and --nhid')
+parser.add_argument('--bptt', type=int_list, default=[35],
+                    help='comma-separated sequence lengths')
+parser.add_argument('--batch-sizes', type=int_list, default=[20],
+                    help='comma-separated batch sizes')
+parser.add_argument('--threads', type=int_list, default=[torch.get_num_threads()],
+                    help='comma-separated numbers of intra-op CPU threads')
+parser.add_argument('--nlayers', type=int, default=2,
+                    help='number of layers')
+parser.add_argument('--nhead', type=int, default=2,
+                    help='the number of heads in the encoder of the transformer model')
+parser.add_argument('--vocab', type=int, default=33278,
+                    help='vocabulary size of the synthetic corpus (33278 is Wikitext-2)')
+parser.add_argument('--tokens', type=int, default=200000,
+                    help='length of the synthetic corpus')
+parser.add_argument('--zipf', type=float, default=1.0,
+                    help='exponent of the Zipf distribution the tokens are drawn from (0 = uniform)')
+parser.add_argument('--train-batches', type=int, default=20,
+                    help='timed training batches per configuration')
+parser.add_argument('--eval-batches', type=int, default=20,
+                    help='timed evaluation batches per configuration')
+parser.add_argument('--words', type=int, default=100,
+                    help='timed generation steps per configuration')
+parser.add_argument('--warmup', type=int, default=3,
+                    help='untimed batches or steps before each measurement')
+parser.add_argument('--seed', type=int, default=1111,
+                    help='random seed')
+parser.add_argument('--cuda', action='store_true',
+                    help='use CUDA')
+parser.add_argument('--output', type=str, default='',
+                    help='write the results as JSON to this file (default: stdout)')
+parser.add_argument('--baseline', type=str, default='',
+                    help='JSON results of an earlier run to compare against')
+parser.add_argument('--tolerance', type=float, default=0.05,
+                    help='relative slowdown against --baseline that counts as a regression')
+# Set on the child process that measures a single configuration.
+parser.add_argument('--run-config', type=str, default='', help=argparse.SUPPRESS)
+args = parser.parse_args()
+if not set(args.decoders.split(',')) <= {'full', 'adaptive'}:
+    parser.error('--decoders takes full and/or adaptive')
+
+device = torch.device('cuda' if args.cuda else 'cpu')
+torch.manual_seed(args.seed)
+
+# Only the measured throughputs are compared against the baseline.
+METRICS = ['train_tokens_per_sec', 'eval_tokens_per_sec', 'generate_tokens_per_sec']
+KEYS = ['model', 'decoder', 'size', 'bptt', 'batch_size', 'threads']
+
+
+def zipf_weights(ntokens, exponent):
+    return torch.arange(1, ntokens + 1, dtype=torch.double).pow(-exponent)
+
+
+def synthetic_corpus(ntokens, length, exponent):
+    """Draws `length` token ids whose frequencies follow a Zipf distribution, like words do."""
+    return torch.multinomial(zipf_weights(ntokens, exponent), length, replacement=True)
+
+
+def adaptive_cutoffs(ntokens, exponent, coverage=(0.8, 0.95)):
+    """Cluster starts at each coverage fraction of the probability mass, the rule main.py applies to counts.
+
+    The synthetic ids are already in decreasing order of frequency, so they are their own frequency ranks.
+    """
+    weights = zipf_weights(ntokens, exponent)
+    cumulative = weights.cumsum(0) / weights.sum()
+    cutoffs = [int((cumulative < c).sum()) + 1 for c in coverage]
+    return sorted(set(c for c in cutoffs if 0 < c < ntokens))
+
+
+def batchify(ids, bsz):
+    nbatch = ids.size(0) // bsz
+    return ids.narrow(0, 0, nbatch * bsz).view(bsz, -1).t().contiguous().to(device)
+
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def batches(source, bptt, count):
+    """Cycles through the (data, target) chunks of `source` for `count` batches."""
+    starts = range(0, source.size(0) - 1 - bptt, bptt)
+    if not starts:
+        raise ValueError('The corpus is too short for a sequence length of {}'.format(bptt))
+    for i in itertools.islice(itertools.cycle(starts), count):
+        yield source[i:i + bptt], source[i + 1:i + 1 + bptt].view(-1)
+
+
+def repackage_hidden(h):
+    if isinstance(h, torch.Tensor):
+        return h.detach()
+    return tuple(repackage_hidden(v) for v in h)
+
+
+def throughput(run, count, tokens_per_unit):
+    """Calls run(--warmup) untimed, then times run(count) and returns the tokens processed per second."""
+    run(args.warmup)
+    synchronize()
+    start = time.perf_counter()
+    run(count)
+    synchronize()
+    return count * tokens_per_unit / (time.perf_counter() - start)
+
+
+def measure(model_type, decoder, size, bptt, batch_size, ids):
+    cutoffs = adaptive_cutoffs(args.vocab, args.zipf) if decoder == 'adaptive' else None
+    config = {'model': model_type, 'ntokens': args.vocab, 'emsize': size, 'nhid': size,
+              'nlayers': args.nlayers, 'nhead': args.nhead, 'dropout': 0.2, 'tied': False, 'cutoffs': cutoffs}
+    net = model.build_model(config).to(device)
+    is_transformer = model_type == 'Transformer'
+    source = batchify(ids, batch_size)
+    params = list(net.parameters())
+
+    def loss_of(data, targets, hidden):
+        if is_transformer:
+            return net(data, targets=targets), None
+        loss, hidden = net(data, hidden, targets)
+        return loss, repackage_hidden(hidden)
+
+    def train(nbatches):
+        net.train()
+        hidden = None if is_transformer else net.init_hidden(batch_size)
+        for data, targets in batches(source, bptt, nbatches):
+            net.zero_grad()
+            loss, hidden = loss_of(data, targets, hidden)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(params, 0.25)
+            with torch.no_grad():
+                for p in params:
+                    # Adaptive softmax clusters without targets in the batch have no gradient.
+                    if p.grad is not None:
+                        p.add_(p.grad, alpha=-20)
+
+    def evaluate(nbatches):
+        net.eval()
+        hidden = None if is_transformer else net.init_hidden(batch_size)
+        with torch.no_grad():
+            for data, targets in batches(source, bptt, nbatches):
+                _, hidden = loss_of(data, targets, hidden)
+
+    def generate(nwords):
+        net.eval()
+        if is_transformer:
+            cache = net.init_cache()
+        else:
+            hidden = net.init_hidden(batch_size)
+        input = torch.randint(args.vocab, (1, batch_size), device=device)
+        with torch.no_grad():
+            for _ in range(nwords):
+                if is_transformer:
+                    output, cache = net.forward_incremental(input, cache)
+                else:
+                    output, hidden = net(input, hidden)
+                input = sampling.sample(output.view(batch_size, -1)).view(1, -1)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    return {
+        'train_tokens_per_sec': throughput(train, args.train_batches, bptt * batch_size),
+        'eval_tokens_per_sec': throughput(evaluate, args.eval_batches, bptt * batch_size),
+        # Every step samples one token for each of the batch_size streams.
+        'generate_tokens_per_sec': throughput(generate, args.words, batch_size),
+        # On CPU this is the peak resident set size of the process, which only
+        # measures this configuration, plus the interpreter and the corpus.
+        'peak_memory_mb': profiling.peak_memory_mb(device),
+    }
+
+
+def print_decoder_speedups(results):
+    """Prints the adaptive softmax throughput relative to the full softmax of the same configuration."""
+    full = {tuple(r[k] for k in KEYS if k != 'decoder'): r for r in results if r['decoder'] == 'full'}
+    for result in results:
+        key = tuple(result[k] for k in KEYS if k != 'decoder')
+        if result['decoder'] != 'adaptive' or key not in full:
+            continue
+        print('| {:<12} | size {:4d} | bptt {:4d} | bsz {:4d} | threads {:3d} | adaptive over full softmax: '
+              'train {:5.2f}x | eval {:5.2f}x | generate {:5.2f}x'.format(
+                  *key, *(result[m] / full[key][m] for m in METRICS)), file=sys.stderr)
+
+
+def compare(results, baseline):
+    """Prints the throughput of `results` relative to `baseline` and returns the number of regressions."""
+    # Runs from before the --decoders axis used the full softmax.
+    by_key = {tuple(r.get(k, 'full') for k in KEYS): r for r in baseline['results']}
+    regressions = 0
+    print('{:<12} {:<8} {:>5} {:>5} {:>5} {:>7} | {:>24} {:>8}'.format(
+        'model', 'decoder', 'size', 'bptt', 'bsz', 'threads', 'metric', 'ratio'), file=sys.stderr)
+    for result in results:
+        key = tuple(result[k] for k in KEYS)
+        old = by_key.get(key)
+        if old is None:
+            print('{:<12} {:<8} {:5d} {:5d} {:5d} {:7d} | not in baseline'.format(*key), file=sys.stderr)
+            continue
+        for metric in METRICS:
+            ratio = result[metric] / old[metric]
+            regressed = ratio < 1 - args.tolerance
+            regressions += regressed
+            print('{:<12} {:<8} {:5d} {:5d} {:5d} {:7d} | {:>24} {:7.3f}x{}'.format(
+                *key, metric, ratio, '  REGRESSION' if regressed else ''), file=sys.stderr)
+    return regressions
+
+
+def measure_in_subprocess(result):
+    """Reruns this script with --run-config to measure one configuration in a fresh process."""
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--run-config', json.dumps(result)]
+    return json.loads(subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout)
+
+
+if args.run_config:
+    # The corpus is drawn from the same seed in every process.
+    config = json.loads(args.run_config)
+    torch.set_num_threads(config['threads'])
+    ids = synthetic_corpus(args.vocab, args.tokens, args.zipf)
+    json.dump(measure(config['model'], config['decoder'], config['size'], config['bptt'], config['batch_size'], ids),
+              sys.stdout)
+    sys.exit()
+
+results = []
+for model_type, decoder, size, bptt, batch_size, threads in itertools.product(
+        args.models.split(','), args.decoders.split(','), args.sizes, args.bptt, args.batch_sizes, args.threads):
+    result = {'model': model_type, 'decoder': decoder, 'size': size, 'bptt': bptt, 'batch_size': batch_size,
+              'threads': threads}
+    result.update(measure_in_subprocess(result))
+    print('| {model:<12} | {decoder:<8} | size {size:4d} | bptt {bptt:4d} | bsz {batch_size:4d} | threads {threads:3d} | '
+          'train {train_tokens_per_sec:9.0f} tok/s | eval {eval_tokens_per_sec:9.0f} tok/s | '
+          'generate {generate_tokens_per_sec:8.0f} tok/s | peak mem {peak_memory_mb:8.1f} MB'.format(**result),
+          file=sys.stderr)
+    results.append(result)
+print_decoder_speedups(results)
+
+report = {
+    'config': {'vocab': args.vocab, 'tokens': args.tokens, 'zipf': args.zipf, 'nlayers': args.nlayers,
+               'nhead': args.nhead, 'train_batches': args.train_batches, 'eval_batches': args.eval_batches,
+               'words': args.words, 'device': str(device), 'torch': torch.__version__,
+               'python': platform.python_version(), 'machine': platform.machine()},
+    'results': results,
+}
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline)
+    if regressions:
+        print('{} metrics regressed by more than {:.0%}'.format(regressions, args.tolerance), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,102 @@
+###############################################################################
+# Causal attention microbenchmark
+#
+# Times the forward and backward of TransformerModel over a range of sequence
+# lengths, once with the mask rebuilt on the CPU and copied to the device for
+# every length change (the original behavior) and once with the cached causal
+# mask and the fused causal attention path.
+#
+###############################################################################
+
+import argparse
+import time
+
+import torch
+
+import model
+
+parser = argparse.ArgumentParser(description='TransformerModel causal attention microbenchmark')
+parser.add_argument('--lengths', type=str, default='35,128,256,512,1024,2048',
+                    help='comma-separated sequence lengths')
+parser.add_argument('--batch_size', type=int, default=8,
+                    help='batch size')
+parser.add_argument('--ntokens', type=int, default=10000,
+                    help='vocabulary size')
+parser.add_argument('--emsize', type=int, default=200,
+                    help='size of word embeddings')
+parser.add_argument('--nhid', type=int, default=200,
+                    help='number of hidden units per layer')
+parser.add_argument('--nlayers', type=int, default=2,
+                    help='number of layers')
+parser.add_argument('--nhead', type=int, default=2,
+                    help='the number of heads in the encoder of the transformer model')
+parser.add_argument('--iters', type=int, default=10,
+                    help='timed iterations per length')
+parser.add_argument('--warmup', type=int, default=3,
+                    help='untimed iterations per length')
+parser.add_argument('--threads', type=int, default=0,
+                    help='number of intra-op CPU threads (0 = default)')
+parser.add_argument('--cuda', action='store_true',
+                    help='use CUDA')
+args = parser.parse_args()
+
+device = torch.device('cuda' if args.cuda else 'cpu')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+
+class LegacyMaskModel(model.TransformerModel):
+    """Builds the float mask on the CPU on every call and passes it without the causal hint."""
+
+    def forward(self, src, has_mask=True, targets=None):
+        mask = (torch.triu(torch.ones(src.size(0), src.size(0))) == 1).transpose(0, 1)
+        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
+        self.src_mask = mask.to(src.device)
+        src = self.pos_encoder(self.encoder(src) * self.ninp ** 0.5)
+        return model._decode(self.decoder, self.transformer_encoder(src, self.src_mask), targets)
+
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_model(net, length):
+    """Returns the mean forward and forward+backward times in ms for one length."""
+    data = torch.randint(args.ntokens, (length, args.batch_size), device=device)
+    targets = torch.randint(args.ntokens, (length * args.batch_size,), device=device)
+    net.eval()
+    with torch.no_grad():
+        for i in range(args.warmup + args.iters):
+            if i == args.warmup:
+                synchronize()
+                start = time.perf_counter()
+            net(data)
+    synchronize()
+    forward = (time.perf_counter() - start) * 1000 / args.iters
+    net.train()
+    for i in range(args.warmup + args.iters):
+        if i == args.warmup:
+            synchronize()
+            start = time.perf_counter()
+        net.zero_grad()
+        net(data, targets=targets).backward()
+    synchronize()
+    train = (time.perf_counter() - start) * 1000 / args.iters
+    return forward, train
+
+
+torch.manual_seed(0)
+# Dropout is disabled so both models compute the same function.
+config = (args.ntokens, args.emsize, args.nhead, args.nhid, args.nlayers, 0.0)
+fast = model.TransformerModel(*config).to(device)
+legacy = LegacyMaskModel(*config).to(device)
+legacy.load_state_dict(fast.state_dict())
+
+print('{:>6} | {:>13} {:>13} | {:>13} {:>13} | {:>8}'.format(
+    'length', 'fwd legacy ms', 'fwd cached ms', 'f+b legacy ms', 'f+b cached ms', 'speedup'))
+for length in [int(n) for n in args.lengths.split(',')]:
+    legacy_forward, legacy_train = time_model(legacy, length)
+    fast_forward, fast_train = time_model(fast, length)
+    print('{:6d} | {:13.2f} {:13.2f} | {:13.2f} {:13.2f} | {:7.2f}x'.format(
+        length, legacy_forward, fast_forward, legacy_train, fast_train, legacy_train / fast_train))
@@ -0,0 +1,51 @@
+import os
+import threading
+
+import torch
+
+
+def snapshot(state_dict):
+    """Copies every tensor of `state_dict` to the CPU, so training can keep updating the originals."""
+    return {key: value.detach().to('cpu', copy=True) for key, value in state_dict.items()}
+
+
+def atomic_save(obj, path):
+    """Saves `obj` to a temporary file first, so `path` always holds a complete checkpoint."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+    os.replace(tmp, path)
+
+
+class CheckpointWriter(object):
+    """Serializes checkpoints on a background thread.
+
+    `save` takes the CPU snapshot synchronously and returns while the file is
+    written. At most one write is in flight; a new `save` waits for the
+    previous one, which bounds the memory held by snapshots.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, obj, path):
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(obj, path), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """Blocks until the pending write, if any, is on disk."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self, obj, path):
+        try:
+            atomic_save(obj, path)
+        except Exception as e:
+            # Re-raised by the next wait().
+            self.error = e
@@ -0,0 +1,32 @@
+import torch
+import torch.distributed as dist
+
+
+def grad_squared_norm(p):
+    """Squared 2-norm of `p.grad`.
+
+    A sparse gradient is coalesced in place first, since the norm of its values
+    would otherwise count repeated tokens separately.
+    """
+    if p.grad.is_sparse:
+        p.grad = p.grad.coalesce()
+        return p.grad.values().pow(2).sum()
+    return p.grad.pow(2).sum()
+
+
+def clip_coef(squared_norms, max_norm, sharded_squared_norms=(), group=None):
+    """Returns the total gradient norm and the factor that scales it to at most `max_norm`.
+
+    `squared_norms` are those of gradients every rank holds in full and are
+    counted once; `sharded_squared_norms` are those of gradients split across
+    the ranks of `group` and are summed over them. The rule is that of
+    torch.nn.utils.clip_grad_norm_, but the factor stays a tensor, so nothing
+    waits for the device.
+    """
+    total = sum(squared_norms)
+    if sharded_squared_norms:
+        sharded = sum(sharded_squared_norms)
+        dist.all_reduce(sharded, group=group)
+        total = total + sharded
+    total_norm = total.sqrt()
+    return total_norm, (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
@@ -1,4 +1,10 @@
+import io
 import os
+import json
+import multiprocessing
+import queue
+import threading
+from array import array
 from io import open
 import torch
 
@@ -18,31 +24,260 @@ class Dictionary(object):
 
 
 class Corpus(object):
-    def __init__(self, path):
+    """Tokenized train/valid/test splits of a text corpus.
+
+    If `cache_dir` is given, the vocabulary and the int32 token ids of every
+    split are stored there after the first tokenization. Later runs reload the
+    ids through a memory map as long as the size and mtime of the source files
+    are unchanged, so the token streams are backed by the page cache instead of
+    anonymous memory. That only lasts while the ids are read in place, as
+    BPTTLoader does; main.py without --stream still copies every split into an
+    int64 tensor on the device.
+
+    With `workers > 1`, each file is split on line boundaries and the chunks are
+    tokenized in parallel processes. The per-chunk vocabularies are merged in
+    file order, so the resulting dictionary and ids match the serial path. The
+    processes are forked, since main.py and generate.py run at module level and
+    can not be re-imported by spawned ones, so this is not available on Windows.
+    """
+
+    splits = ('train', 'valid', 'test')
+
+    def __init__(self, path, cache_dir=None, workers=1):
         self.dictionary = Dictionary()
-        self.train = self.tokenize(os.path.join(path, 'train.txt'))
-        self.valid = self.tokenize(os.path.join(path, 'valid.txt'))
-        self.test = self.tokenize(os.path.join(path, 'test.txt'))
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError('tokenizing with several workers needs the fork start method, '
+                             'which this platform does not have')
+        self.workers = workers
+        sources = [os.path.join(path, split + '.txt') for split in self.splits]
+        if cache_dir is not None and self.load_cache(cache_dir, sources):
+            return
+        self.train = self.tokenize(sources[0])
+        self.valid = self.tokenize(sources[1])
+        self.test = self.tokenize(sources[2])
+        if cache_dir is not None:
+            self.save_cache(cache_dir, sources)
 
     def tokenize(self, path):
         """Tokenizes a text file."""
         assert os.path.exists(path)
-        # Add words to the dictionary
+        if self.workers > 1:
+            return self.tokenize_parallel(path)
+        # Add words to the dictionary and collect their ids in a single pass.
+        ids = array('q')
         with open(path, 'r', encoding="utf8") as f:
             for line in f:
                 words = line.split() + ['<eos>']
                 for word in words:
-                    self.dictionary.add_word(word)
+                    ids.append(self.dictionary.add_word(word))
+
+        return _to_tensor(ids)
+
+    def tokenize_parallel(self, path):
+        """Tokenizes a text file with `self.workers` processes."""
+        # A few chunks per worker keeps the pool busy when lines vary in length.
+        chunks = _line_aligned_chunks(path, 4 * self.workers)
+        with multiprocessing.get_context('fork').Pool(self.workers) as pool:
+            results = pool.map(_tokenize_chunk, chunks)
+
+        # Words are added in order of first occurrence, chunk by chunk, which
+        # reproduces the ids that the serial path assigns.
+        idss = []
+        for words, local_ids in results:
+            remap = torch.tensor([self.dictionary.add_word(word) for word in words], dtype=torch.int64)
+            idss.append(remap[_to_tensor(local_ids)])
+        if not idss:
+            return torch.zeros(0, dtype=torch.int64)
+        return torch.cat(idss)
+
+    def token_ranks(self):
+        """Ranks the token ids by their training-set frequency, most frequent first.
+
+        Returns the sorted counts and, for every id, its rank.
+        """
+        counts = torch.bincount(self.train.long(), minlength=len(self.dictionary))
+        sorted_counts, order = torch.sort(counts, descending=True)
+        ranks = torch.empty_like(order)
+        ranks[order] = torch.arange(len(order))
+        return sorted_counts, ranks
+
+    @staticmethod
+    def _source_stamp(path):
+        st = os.stat(path)
+        return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def save_cache(self, cache_dir, sources):
+        """Writes the vocabulary and the int32 ids of each split to `cache_dir`."""
+        os.makedirs(cache_dir, exist_ok=True)
+        meta = {'sources': [self._source_stamp(src) for src in sources], 'ntokens': {}}
+        for split in self.splits:
+            ids = getattr(self, split)
+            _atomic_write(os.path.join(cache_dir, split + '.bin'),
+                          lambda f: _write_int32(f, ids))
+            meta['ntokens'][split] = len(ids)
+        # Words never contain whitespace, so one word per line is unambiguous.
+        _atomic_write(os.path.join(cache_dir, 'vocab.txt'),
+                      lambda f: f.write('\n'.join(self.dictionary.idx2word).encode('utf8')))
+        # The metadata is written last: a cache without it is never considered valid.
+        _atomic_write(os.path.join(cache_dir, 'meta.json'),
+                      lambda f: f.write(json.dumps(meta).encode('utf8')))
+
+    def load_cache(self, cache_dir, sources):
+        """Memory-maps a cache written by `save_cache`. Returns False if it is missing or stale."""
+        try:
+            with open(os.path.join(cache_dir, 'meta.json'), 'r', encoding="utf8") as f:
+                meta = json.load(f)
+            if meta['sources'] != [self._source_stamp(src) for src in sources]:
+                return False
+            filenames = [os.path.join(cache_dir, split + '.bin') for split in self.splits]
+            sizes = [meta['ntokens'][split] for split in self.splits]
+            if any(os.path.getsize(fn) != 4 * n for fn, n in zip(filenames, sizes)):
+                return False
+            with open(os.path.join(cache_dir, 'vocab.txt'), 'r', encoding="utf8", newline='\n') as f:
+                words = f.read().split('\n')
+        except (OSError, ValueError, KeyError):
+            return False
+        for word in words:
+            self.dictionary.add_word(word)
+        for split, filename, size in zip(self.splits, filenames, sizes):
+            setattr(self, split, _mmap_int32(filename, size))
+        return True
+
+
+class BPTTLoader(object):
+    """Streams (data, target) BPTT chunks of a 1-D id tensor.
+
+    The chunks have the same column layout as `batchify` followed by
+    `get_batch` in main.py, but are gathered lazily from `ids`, which can be
+    the memory-mapped split of a cached `Corpus`. A background thread copies
+    the next `prefetch` chunks into (pinned, for CUDA) host buffers while the
+    current one is used, so memory use does not grow with the corpus size.
+
+    len() is the number of rows, as for the tensor returned by `batchify`.
+    With `world_size > 1` the stream is laid out in `bsz * world_size` columns
+    and only the `bsz` columns of `rank` are loaded.
+    """
+
+    def __init__(self, ids, bsz, bptt, device, prefetch=2, rank=0, world_size=1):
+        self.nbatch = ids.size(0) // (bsz * world_size)
+        columns = ids.narrow(0, 0, self.nbatch * bsz * world_size).view(bsz * world_size, self.nbatch)
+        self.columns = columns[rank * bsz:(rank + 1) * bsz]
+        self.bptt = bptt
+        self.device = device
+        self.prefetch = prefetch
+        self.pin_memory = device.type == 'cuda'
+
+    def __len__(self):
+        return self.nbatch
+
+    def __iter__(self):
+        return self.batches()
+
+    def batches(self, start=0):
+        """Yields the chunks from the `start`-th one on."""
+        chunks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(chunks, stop, start), daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                chunk = chunk.to(self.device, non_blocking=True)
+                yield chunk[:-1], chunk[1:].reshape(-1)
+        finally:
+            stop.set()
+            thread.join()
+
+    def _produce(self, chunks, stop, start):
+        try:
+            for i in range(start * self.bptt, self.nbatch - 1, self.bptt):
+                seq_len = min(self.bptt, self.nbatch - 1 - i)
+                # One extra row: the targets are the inputs shifted by one.
+                chunk = torch.empty(seq_len + 1, self.columns.size(0), dtype=torch.long,
+                                    pin_memory=self.pin_memory)
+                chunk.copy_(self.columns[:, i:i + seq_len + 1].t())
+                if not _put_unless_stopped(chunks, chunk, stop):
+                    return
+        except Exception as e:
+            # Re-raised by the consuming iterator.
+            _put_unless_stopped(chunks, e, stop)
+            return
+        _put_unless_stopped(chunks, None, stop)
+
+
+def _put_unless_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _line_aligned_chunks(path, nchunks):
+    """Splits `path` into at most `nchunks` byte ranges that start and end on line boundaries."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, nchunks):
+            f.seek(max(size * k // nchunks, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _tokenize_chunk(chunk):
+    """Tokenizes one byte range with a chunk-local vocabulary, in order of first occurrence."""
+    path, start, end = chunk
+    with open(path, 'rb') as f:
+        f.seek(start)
+        raw = f.read(end - start)
+    word2idx = {}
+    ids = array('q')
+    # Decode like the serial path does, including universal newlines.
+    for line in io.TextIOWrapper(io.BytesIO(raw), encoding="utf8"):
+        words = line.split() + ['<eos>']
+        for word in words:
+            idx = word2idx.get(word)
+            if idx is None:
+                idx = word2idx[word] = len(word2idx)
+            ids.append(idx)
+    return list(word2idx), ids
+
+
+def _to_tensor(ids):
+    """Converts an array('q') of ids to an int64 tensor without going through Python ints."""
+    if len(ids) == 0:
+        return torch.zeros(0, dtype=torch.int64)
+    if hasattr(torch, 'frombuffer'):
+        return torch.frombuffer(ids, dtype=torch.int64)
+    return torch.tensor(ids, dtype=torch.int64)
+
+
+def _write_int32(f, ids, chunk=1 << 20):
+    # Converts a chunk at a time, so the int32 copy stays small for large corpora.
+    for i in range(0, len(ids), chunk):
+        ids[i:i+chunk].to(torch.int32).numpy().tofile(f)
+
+
+def _mmap_int32(filename, size):
+    """Maps `size` int32 values from `filename` copy-on-write, without reading them eagerly."""
+    if size == 0:
+        return torch.zeros(0, dtype=torch.int32)
+    if hasattr(torch, 'from_file'):
+        return torch.from_file(filename, shared=False, size=size, dtype=torch.int32)
+    storage = torch.IntStorage.from_file(filename, False, size)
+    return torch.IntTensor(storage)
 
-        # Tokenize file content
-        with open(path, 'r', encoding="utf8") as f:
-            idss = []
-            for line in f:
-                words = line.split() + ['<eos>']
-                ids = []
-                for word in words:
-                    ids.append(self.dictionary.word2idx[word])
-                idss.append(torch.tensor(ids).type(torch.int64))
-            ids = torch.cat(idss)
 
-        return ids
+def _atomic_write(filename, write_fn):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        write_fn(f)
+    os.replace(tmp, filename)
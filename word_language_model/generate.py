@@ -6,10 +6,17 @@
 ###############################################################################
 
 import argparse
+import os
+import pickle
+import time
 
 import torch
+import torch.nn as nn
 
 import data
+import onnx_backend
+import sampling
+from model import build_model
 
 parser = argparse.ArgumentParser(description='PyTorch Wikitext-2 Language Model')
 
@@ -23,13 +30,45 @@ parser.add_argument('--outf', type=str, default='generated.txt',
 parser.add_argument('--words', type=int, default='1000',
                     help='number of words to generate')
 parser.add_argument('--seed', type=int, default=1111,
-                    help='random seed')
+                    help='random seed; stream i samples with seed SEED + i')
 parser.add_argument('--cuda', action='store_true',
                     help='use CUDA')
 parser.add_argument('--temperature', type=float, default=1.0,
                     help='temperature - higher will increase diversity')
+parser.add_argument('--top-k', type=int, default=0,
+                    help='sample only from the k most likely words (0 = no limit)')
+parser.add_argument('--top-p', type=float, default=1.0,
+                    help='sample only from the smallest set of words whose probability exceeds p')
+parser.add_argument('--block-size', type=int, default=128,
+                    help='number of steps whose samples are copied to the host at once')
+parser.add_argument('--quantize', type=str, default='', choices=['', 'dynamic'],
+                    help='convert the checkpoint to an int8 dynamically quantized model (CPU only)')
+parser.add_argument('--save-quantized', type=str, default='',
+                    help='path to save the quantized model')
+parser.add_argument('--backend', type=str, default='pytorch', choices=['pytorch', 'onnxruntime'],
+                    help='run the model with PyTorch or, on CPU, with ONNX Runtime')
+parser.add_argument('--onnx-model', type=str, default='',
+                    help='ONNX model exported by main.py --onnx-export, for --backend onnxruntime')
+parser.add_argument('--threads', type=int, default=0,
+                    help='number of intra-op CPU threads (0 = default)')
+parser.add_argument('--prompt', type=str, default='',
+                    help='text to continue instead of starting from a random word')
+parser.add_argument('--score-file', type=str, default='',
+                    help='instead of generating, write the log-likelihood of every line of this file to --score-outf; '
+                         'lines with words outside a vocabulary without <unk> get nan')
+parser.add_argument('--score-outf', type=str, default='scores.txt',
+                    help='output file for the prompt scores')
+parser.add_argument('--score-batch-size', type=int, default=64,
+                    help='number of prompts of equal length scored in one forward')
 parser.add_argument('--log-interval', type=int, default=100,
                     help='reporting interval')
+parser.add_argument('--num-streams', type=int, default=1,
+                    help='number of independent streams sampled in one batch; '
+                         'stream i is written to OUTF with suffix .i')
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help='directory for the memory-mapped token cache (default: no cache)')
+parser.add_argument('--tokenize-workers', type=int, default=1,
+                    help='number of processes used to tokenize the corpus (forked, not on Windows)')
 args = parser.parse_args()
 
 # Set the random seed manually for reproducibility.
@@ -42,37 +81,166 @@ device = torch.device("cuda" if args.cuda else "cpu")
 
 if args.temperature < 1e-3:
     parser.error("--temperature has to be greater or equal 1e-3")
+if not 0.0 < args.top_p <= 1.0:
+    parser.error("--top-p has to be in (0, 1]")
+if args.quantize and args.cuda:
+    parser.error("--quantize runs on CPU only")
+if args.backend == 'onnxruntime' and (args.cuda or args.quantize or not args.onnx_model):
+    parser.error("--backend onnxruntime requires --onnx-model and runs on CPU without --quantize")
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+if args.num_streams < 1:
+    parser.error("--num-streams has to be at least 1")
 
 with open(args.checkpoint, 'rb') as f:
-    model = torch.load(f).to(device)
+    try:
+        checkpoint = torch.load(f, map_location=device)
+    except pickle.UnpicklingError:
+        # Current PyTorch only loads tensors and plain containers by default. A pickled
+        # model, like those of --save-quantized, has to be fully unpickled, which runs
+        # code from the file, so only load checkpoints from a trusted source.
+        f.seek(0)
+        checkpoint = torch.load(f, map_location=device, weights_only=False)
+if isinstance(checkpoint, dict):
+    # A state_dict checkpoint written by main.py, which also holds the vocabulary.
+    model = build_model(checkpoint['config']).to(device)
+    model.load_state_dict(checkpoint['model'])
+    dictionary = data.Dictionary()
+    for word in checkpoint['vocab']:
+        dictionary.add_word(word)
+else:
+    # A pickled model, e.g. one saved with --save-quantized.
+    model = checkpoint.to(device)
+    dictionary = None
+if args.backend == 'onnxruntime':
+    # The checkpoint still provides the vocabulary.
+    model = onnx_backend.ORTModel(args.onnx_model, args.threads)
 model.eval()
+if args.quantize == 'dynamic':
+    model = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+    if args.save_quantized:
+        with open(args.save_quantized, 'wb') as f:
+            torch.save(model, f)
 
-corpus = data.Corpus(args.data)
-ntokens = len(corpus.dictionary)
+if dictionary is None:
+    dictionary = data.Corpus(args.data, cache_dir=args.cache_dir, workers=args.tokenize_workers).dictionary
+ntokens = len(dictionary)
 
 is_transformer_model = hasattr(model, 'model_type') and model.model_type == 'Transformer'
-if not is_transformer_model:
-    hidden = model.init_hidden(1)
-input = torch.randint(ntokens, (1, 1), dtype=torch.long).to(device)
 
-with open(args.outf, 'w') as outf:
+
+def encode(text):
+    """Maps the words of `text` to ids, after an '<eos>' that stands for the previous line break."""
+    unk = dictionary.word2idx.get('<unk>')
+    ids = []
+    for word in ['<eos>'] + text.split():
+        idx = dictionary.word2idx.get(word, unk)
+        if idx is None:
+            raise ValueError('"{}" is not in the vocabulary'.format(word))
+        ids.append(idx)
+    return ids
+
+
+def log_probs_of(input, hidden=None):
+    """Runs the whole prefix `input` (seq_len x batch) in one forward."""
+    if is_transformer_model:
+        return model(input)
+    output, hidden = model(input, hidden)
+    return output.view(input.size(0), input.size(1), -1)
+
+
+def score_file():
+    """Writes the log-likelihood of every line of --score-file, given the line break before it."""
+    with open(args.score_file, 'r', encoding="utf8") as f:
+        prompts = [line.rstrip('\n') for line in f]
+    encoded = []
+    for n, prompt in enumerate(prompts, 1):
+        try:
+            encoded.append(encode(prompt))
+        except ValueError as e:
+            # Without '<unk>' in the vocabulary such a line has no score.
+            print('WARNING: line {} of {}: {}; its score is written as nan'.format(n, args.score_file, e))
+            encoded.append(None)
+    scores = [0.0 if ids is not None else float('nan') for ids in encoded]
+
+    # Prompts of equal length are stacked into one batch, so no padding is needed.
+    by_length = {}
+    for i, ids in enumerate(encoded):
+        if ids is not None and len(ids) > 1:
+            by_length.setdefault(len(ids), []).append(i)
+    start_time = time.time()
+    with torch.no_grad():
+        for length, indices in sorted(by_length.items()):
+            for b in range(0, len(indices), args.score_batch_size):
+                batch = indices[b:b + args.score_batch_size]
+                ids = torch.tensor([encoded[i] for i in batch], dtype=torch.long).t().to(device)
+                hidden = None if is_transformer_model else model.init_hidden(len(batch))
+                log_probs = log_probs_of(ids[:-1], hidden)
+                log_likelihood = log_probs.gather(2, ids[1:].unsqueeze(2)).sum((0, 2))
+                for i, score in zip(batch, log_likelihood.tolist()):
+                    scores[i] = score
+    elapsed = time.time() - start_time
+
+    with open(args.score_outf, 'w', encoding="utf8") as outf:
+        for prompt, ids, score in zip(prompts, encoded, scores):
+            nwords = len(ids) - 1 if ids is not None else len(prompt.split())
+            outf.write('{:.4f}\t{}\t{}\n'.format(score, nwords, prompt))
+    nwords = sum(len(ids) - 1 for ids in encoded if ids is not None)
+    print('| Scored {} prompts ({} words) | {:5.2f} s | {:8.1f} tokens/s'.format(
+        len(prompts), nwords, elapsed, nwords / elapsed))
+
+
+def generate():
+    streams = args.num_streams
+    if is_transformer_model:
+        # Keys and values of the generated prefix are cached, so each step only runs the newest token.
+        cache = model.init_cache()
+    else:
+        hidden = model.init_hidden(streams)
+    # Every stream draws from its own generator, so stream i gives the same text
+    # whatever --num-streams is.
+    generators = [torch.Generator(device=device).manual_seed(args.seed + s) for s in range(streams)]
+    # One column per stream: every step advances all streams in a single batched forward.
+    if args.prompt:
+        # The first step runs the whole prompt at once to prime the hidden state or cache.
+        input = torch.tensor(encode(args.prompt), dtype=torch.long).view(-1, 1).repeat(1, streams).to(device)
+    else:
+        input = torch.cat([torch.randint(ntokens, (1, 1), generator=g, device=device) for g in generators], 1)
+
+    if streams == 1:
+        outf_names = [args.outf]
+    else:
+        root, ext = os.path.splitext(args.outf)
+        outf_names = ['{}.{}{}'.format(root, s, ext) for s in range(streams)]
+    outfs = [open(name, 'w') for name in outf_names]
+    if args.prompt:
+        for outf in outfs:
+            outf.write(' '.join(args.prompt.split()) + ' ')
+
+    # Samples stay on the device; they are copied back and written to disk in blocks.
+    writer = sampling.TokenWriter(outfs, dictionary.idx2word, block_size=args.block_size)
+    start_time = time.time()
     with torch.no_grad():  # no tracking history
         for i in range(args.words):
             if is_transformer_model:
-                output = model(input, False)
-                word_weights = output[-1].squeeze().div(args.temperature).exp().cpu()
-                word_idx = torch.multinomial(word_weights, 1)[0]
-                word_tensor = torch.Tensor([[word_idx]]).long().to(device)
-                input = torch.cat([input, word_tensor], 0)
+                output, cache = model.forward_incremental(input, cache)
             else:
                 output, hidden = model(input, hidden)
-                word_weights = output.squeeze().div(args.temperature).exp().cpu()
-                word_idx = torch.multinomial(word_weights, 1)[0]
-                input.fill_(word_idx)
-
-            word = corpus.dictionary.idx2word[word_idx]
-
-            outf.write(word + ('\n' if i % 20 == 19 else ' '))
+            output = output.view(input.size(0), streams, -1)[-1]
+            word_idx = sampling.sample(output, args.temperature, args.top_k, args.top_p, generators)
+            input = word_idx.view(1, -1)
+            writer.append(word_idx)
 
             if i % args.log_interval == 0:
                 print('| Generated {}/{} words'.format(i, args.words))
+    writer.close()
+
+    elapsed = time.time() - start_time
+    print('| Generated {} words in {} streams | {:5.2f} s | {:8.1f} tokens/s'.format(
+        args.words, streams, elapsed, args.words * streams / elapsed))
+
+
+if args.score_file:
+    score_file()
+else:
+    generate()
@@ -4,11 +4,18 @@ import time
 import math
 import os
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-import torch.onnx
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
 
+import checkpoint
+import clipping
 import data
 import model
+import onnx_backend
+import profiling
+import vocab_parallel
 
 parser = argparse.ArgumentParser(description='PyTorch Wikitext-2 RNN/LSTM/GRU/Transformer Language Model')
 parser.add_argument('--data', type=str, default='./data/wikitext-2',
@@ -43,13 +50,73 @@ parser.add_argument('--log-interval', type=int, default=200, metavar='N',
                     help='report interval')
 parser.add_argument('--save', type=str, default='model.pt',
                     help='path to save the final model')
+parser.add_argument('--checkpoint', type=str, default='',
+                    help='path to save the latest training state for --resume after every epoch')
+parser.add_argument('--checkpoint-interval', type=int, default=0, metavar='N',
+                    help='also save the latest training state every N batches (0 = end of epoch only)')
+parser.add_argument('--resume', type=str, default='',
+                    help='checkpoint to resume training from')
 parser.add_argument('--onnx-export', type=str, default='',
                     help='path to export the final model in onnx format')
+parser.add_argument('--backend', type=str, default='pytorch', choices=['pytorch', 'onnxruntime'],
+                    help='with onnxruntime, also evaluate the exported ONNX model on the test data with '
+                         'ONNX Runtime and compare it to PyTorch')
 
 parser.add_argument('--nhead', type=int, default=2,
                     help='the number of heads in the encoder/decoder of the transformer model')
+parser.add_argument('--checkpoint-layers', type=int, default=0,
+                    help='number of Transformer encoder layers whose activations are recomputed '
+                         'during backward to save memory')
 parser.add_argument('--dry-run', action='store_true',
                     help='verify the code and the model')
+parser.add_argument('--adaptive', action='store_true',
+                    help='use a clustered adaptive softmax decoder')
+parser.add_argument('--cutoffs', type=str, default='',
+                    help='comma-separated frequency ranks at which the adaptive softmax clusters start '
+                         '(default: the ranks covering 80%% and 95%% of the training tokens)')
+parser.add_argument('--stream', action='store_true',
+                    help='stream batches from the corpus on a background thread instead of '
+                         'placing whole splits on the device (use with --cache-dir to keep memory bounded)')
+parser.add_argument('--sparse-embedding', action='store_true',
+                    help='compute sparse gradients for the word embedding, so that clipping and the update '
+                         'only touch the rows of the tokens in the batch (dense with --tied)')
+parser.add_argument('--flat-params', action='store_true',
+                    help='keep parameters and gradients in flat buffers so that clipping and '
+                         'the update are single vectorized operations')
+parser.add_argument('--profile-json', type=str, default='',
+                    help='time each phase of the training step and write the aggregates to this JSON file')
+parser.add_argument('--profile-trace', type=str, default='',
+                    help='path to save a torch.profiler Chrome trace of a window of training batches')
+parser.add_argument('--profile-start', type=int, default=10,
+                    help='first batch of the profiler trace window')
+parser.add_argument('--profile-batches', type=int, default=5,
+                    help='number of batches in the profiler trace window')
+parser.add_argument('--quantize', type=str, default='', choices=['', 'dynamic'],
+                    help='after training, also evaluate an int8 dynamically quantized copy of the '
+                         'best model on CPU and report the perplexity delta and tokens/sec')
+parser.add_argument('--save-quantized', type=str, default='',
+                    help='path to save the quantized model')
+parser.add_argument('--distributed', action='store_true',
+                    help='data-parallel training over the processes started by torchrun')
+parser.add_argument('--dist-backend', type=str, default='gloo',
+                    help='distributed backend')
+parser.add_argument('--vocab-parallel', action='store_true',
+                    help='with --distributed, split the embedding and decoder rows of an RNN model across the '
+                         'processes instead of splitting the batches')
+parser.add_argument('--threads', type=int, default=0,
+                    help='number of intra-op CPU threads per process (0 = PyTorch default)')
+parser.add_argument('--eval-batch-size', type=int, default=10,
+                    help='evaluation batch size (columns, or windows per forward with --eval-context)')
+parser.add_argument('--eval-context', type=int, default=0,
+                    help='also evaluate the test set of a Transformer with overlapping windows of this many '
+                         'tokens (0 = off)')
+parser.add_argument('--eval-stride', type=int, default=0,
+                    help='offset between consecutive evaluation windows; only the last EVAL_STRIDE targets '
+                         'of a window are scored (default: --eval-context, i.e. no overlap)')
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help='directory for the memory-mapped token cache (default: no cache)')
+parser.add_argument('--tokenize-workers', type=int, default=1,
+                    help='number of processes used to tokenize the corpus (forked, not on Windows)')
 
 args = parser.parse_args()
 
@@ -60,12 +127,64 @@ if torch.cuda.is_available():
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
 device = torch.device("cuda" if args.cuda else "cpu")
+if args.quantize and args.cuda:
+    parser.error('--quantize runs on CPU only')
+if args.backend == 'onnxruntime' and not args.onnx_export:
+    parser.error('--backend onnxruntime requires --onnx-export')
+if args.backend == 'onnxruntime' and args.distributed:
+    parser.error('--backend onnxruntime can not be combined with --distributed; '
+                 'evaluate the exported model in a single process instead')
+if args.checkpoint_layers and args.model != 'Transformer':
+    parser.error('--checkpoint-layers requires --model Transformer')
+if args.eval_context:
+    args.eval_stride = args.eval_stride or args.eval_context
+    if args.model != 'Transformer':
+        parser.error('--eval-context requires --model Transformer')
+    if not 0 < args.eval_stride <= args.eval_context:
+        parser.error('--eval-stride has to be in [1, EVAL_CONTEXT]')
+if args.sparse_embedding and (args.flat_params or args.vocab_parallel):
+    parser.error('--sparse-embedding can not be combined with --flat-params or --vocab-parallel')
+if args.vocab_parallel:
+    if not args.distributed:
+        parser.error('--vocab-parallel requires --distributed')
+    if args.model == 'Transformer' or args.adaptive or args.flat_params:
+        parser.error('--vocab-parallel supports RNN models without --adaptive and --flat-params')
+    if args.quantize or args.onnx_export:
+        parser.error('--vocab-parallel can not be combined with --quantize or --onnx-export; '
+                     'run them on the saved checkpoint instead')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+rank, world_size = 0, 1
+if args.distributed:
+    # torchrun provides RANK, WORLD_SIZE, LOCAL_RANK and the rendezvous address.
+    dist.init_process_group(backend=args.dist_backend, init_method='env://')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if args.cuda:
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+
+
+def log(*messages):
+    """Prints the progress reports, which only rank 0 writes; warnings and errors still use print."""
+    if rank == 0:
+        print(*messages)
+
+
+# With --vocab-parallel every rank trains on the same batches and holds part of the vocabulary.
+data_rank, data_world_size = (0, 1) if args.vocab_parallel else (rank, world_size)
 
 ###############################################################################
 # Load data
 ###############################################################################
 
-corpus = data.Corpus(args.data)
+# Rank 0 tokenizes and writes the cache first; the other ranks then load it
+# instead of writing the same files at the same time.
+if args.distributed and args.cache_dir and rank != 0:
+    dist.barrier()
+corpus = data.Corpus(args.data, cache_dir=args.cache_dir, workers=args.tokenize_workers)
+if args.distributed and args.cache_dir and rank == 0:
+    dist.barrier()
 
 # Starting from sequential data, batchify arranges the dataset into columns.
 # For instance, with the alphabet as the sequence and batch size 4, we'd get
@@ -78,37 +197,140 @@ corpus = data.Corpus(args.data)
 # These columns are treated as independent by the model, which means that the
 # dependence of e. g. 'g' on 'f' can not be learned, but allows more efficient
 # batch processing.
+# In data-parallel mode the data is divided into bsz * world_size columns and
+# every rank keeps its own bsz of them.
 
 def batchify(data, bsz):
-    # Work out how cleanly we can divide the dataset into bsz parts.
-    nbatch = data.size(0) // bsz
+    # Work out how cleanly we can divide the dataset into bsz parts per rank.
+    nbatch = data.size(0) // (bsz * data_world_size)
     # Trim off any extra elements that wouldn't cleanly fit (remainders).
-    data = data.narrow(0, 0, nbatch * bsz)
-    # Evenly divide the data across the bsz batches.
-    data = data.view(bsz, -1).t().contiguous()
-    return data.to(device)
-
-eval_batch_size = 10
-train_data = batchify(corpus.train, args.batch_size)
-val_data = batchify(corpus.valid, eval_batch_size)
-test_data = batchify(corpus.test, eval_batch_size)
+    data = data.narrow(0, 0, nbatch * bsz * data_world_size)
+    # Evenly divide the data across the bsz batches of every rank.
+    data = data.view(bsz * data_world_size, -1)[data_rank * bsz:(data_rank + 1) * bsz]
+    # Cached corpora hold int32 ids; the embedding expects int64. The transpose is
+    # made contiguous by the same copy that converts it, so the split is copied once.
+    return data.t().to(device, torch.long, memory_format=torch.contiguous_format)
+
+eval_batch_size = args.eval_batch_size
+if args.stream:
+    # Same layout as batchify, but chunks are gathered and prefetched on demand.
+    train_data = data.BPTTLoader(corpus.train, args.batch_size, args.bptt, device,
+                                 rank=data_rank, world_size=data_world_size)
+    val_data = data.BPTTLoader(corpus.valid, eval_batch_size, args.bptt, device,
+                               rank=data_rank, world_size=data_world_size)
+    test_data = data.BPTTLoader(corpus.test, eval_batch_size, args.bptt, device,
+                                rank=data_rank, world_size=data_world_size)
+else:
+    train_data = batchify(corpus.train, args.batch_size)
+    val_data = batchify(corpus.valid, eval_batch_size)
+    test_data = batchify(corpus.test, eval_batch_size)
 
 ###############################################################################
 # Build the model
 ###############################################################################
 
-ntokens = len(corpus.dictionary)
-if args.model == 'Transformer':
-    model = model.TransformerModel(ntokens, args.emsize, args.nhead, args.nhid, args.nlayers, args.dropout).to(device)
-else:
-    model = model.RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout, args.tied).to(device)
+def adaptive_cutoffs(sorted_counts, coverage=(0.8, 0.95)):
+    # Start a new cluster at the first rank past each coverage fraction of the training tokens.
+    cumulative = sorted_counts.double().cumsum(0) / sorted_counts.sum()
+    cutoffs = [int((cumulative < c).sum()) + 1 for c in coverage]
+    return sorted(set(c for c in cutoffs if 0 < c < len(sorted_counts)))
 
-criterion = nn.NLLLoss()
+ntokens = len(corpus.dictionary)
+cutoffs, token_rank = None, None
+if args.adaptive:
+    sorted_counts, token_rank = corpus.token_ranks()
+    if args.cutoffs:
+        cutoffs = [int(c) for c in args.cutoffs.split(',')]
+    else:
+        cutoffs = adaptive_cutoffs(sorted_counts)
+    if not cutoffs:
+        parser.error('the vocabulary is too small for an adaptive softmax')
+    log('Adaptive softmax cutoffs: {}'.format(cutoffs))
+
+# Stored in the checkpoints, so that generate.py can rebuild the model.
+model_config = {'model': args.model, 'ntokens': ntokens, 'emsize': args.emsize, 'nhid': args.nhid,
+                'nlayers': args.nlayers, 'nhead': args.nhead, 'dropout': args.dropout, 'tied': args.tied,
+                'cutoffs': cutoffs}
+model = model.build_model(model_config, token_rank, shard_vocab=args.vocab_parallel,
+                          sparse_embedding=args.sparse_embedding).to(device)
+if args.sparse_embedding and not model.encoder.sparse:
+    log('The embedding is tied to the decoder, whose gradient is dense; --sparse-embedding is ignored')
+if args.checkpoint_layers:
+    model.checkpoint_layers = min(args.checkpoint_layers, args.nlayers)
 
 ###############################################################################
 # Training code
 ###############################################################################
 
+class FlatParameters(object):
+    """Moves all parameters and their gradients into two contiguous buffers.
+
+    Every parameter becomes a view into `data` and its gradient a view into
+    `grad`, so gradient clipping and the SGD update each run as one operation
+    over the whole model instead of one small kernel per parameter.
+    Backward accumulates into the existing views, so the gradients must be
+    reset with `zero_grad` here rather than with `model.zero_grad()`.
+    """
+
+    def __init__(self, params):
+        params = list(params)
+        total = sum(p.numel() for p in params)
+        self.data = params[0].new_empty(total)
+        self.grad = params[0].new_zeros(total)
+        offset = 0
+        for p in params:
+            n = p.numel()
+            self.data[offset:offset + n].copy_(p.data.view(-1))
+            p.data = self.data[offset:offset + n].view_as(p)
+            p.grad = self.grad[offset:offset + n].view_as(p)
+            offset += n
+
+    def zero_grad(self):
+        self.grad.zero_()
+
+    def clip_grad_norm_(self, max_norm):
+        total_norm, clip_coef = clipping.clip_coef([self.grad.pow(2).sum()], max_norm)
+        self.grad.mul_(clip_coef)
+        return total_norm
+
+    def sgd_step(self, lr):
+        self.data.add_(self.grad, alpha=-lr)
+
+
+flat_params = FlatParameters(model.parameters()) if args.flat_params else None
+# Gradients are averaged across ranks during backward; evaluation uses the plain module.
+# Clusters of the adaptive softmax that no target falls into get no gradient.
+# With --vocab-parallel the replicated layers see the same batches, so their gradients already agree.
+if args.distributed and not args.vocab_parallel:
+    train_model = DDP(model, find_unused_parameters=args.adaptive)
+else:
+    train_model = model
+timer = profiling.PhaseTimer(device, enabled=bool(args.profile_json))
+# The adaptive and vocabulary-parallel decoders compute the loss in the same
+# call as the output layer; a plain nn.Linear decoder lets it be timed apart.
+separate_loss = isinstance(model.decoder, nn.Linear)
+trace = None
+if args.profile_trace and rank == 0:
+    trace = profiling.TraceWindow(args.profile_trace, args.profile_start, args.profile_batches, device)
+
+
+def clip_grad_norm_(parameters, max_norm):
+    """torch.nn.utils.clip_grad_norm_ that also takes the sparse gradient of --sparse-embedding.
+
+    A sparse gradient is coalesced first, since the norm of its values would
+    otherwise count repeated tokens separately, and then only its nonzero rows
+    are scaled.
+    """
+    params = [p for p in parameters if p.grad is not None]
+    total_norm, clip_coef = clipping.clip_coef([clipping.grad_squared_norm(p) for p in params], max_norm)
+    for p in params:
+        if p.grad.is_sparse:
+            p.grad = p.grad * clip_coef
+        else:
+            p.grad.mul_(clip_coef)
+    return total_norm
+
+
 def repackage_hidden(h):
     """Wraps hidden states in new Tensors, to detach them from their history."""
 
@@ -135,120 +357,293 @@ def get_batch(source, i):
     return data, target
 
 
+def iterate_batches(source, start=0):
+    """Yields the (data, target) chunks of `source`, skipping the first `start` of them."""
+    if isinstance(source, data.BPTTLoader):
+        return source.batches(start)
+    return (get_batch(source, i) for i in range(start * args.bptt, source.size(0) - 1, args.bptt))
+
+
 def evaluate(data_source):
     # Turn on evaluation mode which disables dropout.
     model.eval()
     total_loss = 0.
-    ntokens = len(corpus.dictionary)
     if args.model != 'Transformer':
         hidden = model.init_hidden(eval_batch_size)
     with torch.no_grad():
-        for i in range(0, data_source.size(0) - 1, args.bptt):
-            data, targets = get_batch(data_source, i)
+        for data, targets in iterate_batches(data_source):
+            # The model returns the mean negative log-likelihood of the targets.
             if args.model == 'Transformer':
-                output = model(data)
-                output = output.view(-1, ntokens)
+                loss = model(data, targets=targets)
             else:
-                output, hidden = model(data, hidden)
+                loss, hidden = model(data, hidden, targets)
                 hidden = repackage_hidden(hidden)
-            total_loss += len(data) * criterion(output, targets).item()
-    return total_loss / (len(data_source) - 1)
-
-
-def train():
+            total_loss += len(data) * loss.item()
+    total_loss /= len(data_source) - 1
+    if data_world_size > 1:
+        # Every rank evaluates the same number of tokens, so the global loss is the mean.
+        total_loss = torch.tensor(total_loss, dtype=torch.float64)
+        dist.all_reduce(total_loss)
+        total_loss = total_loss.item() / data_world_size
+    return total_loss
+
+
+def evaluate_sliding(ids):
+    """Evaluates the 1-D id stream `ids` with windows of args.eval_context tokens.
+
+    Consecutive windows start args.eval_stride tokens apart and each one only
+    scores the targets that no earlier window scored, so every token after the
+    first window is predicted from at least eval_context - eval_stride tokens of
+    context. Windows have equal length and eval_batch_size of them are run in one
+    forward. Only the scored positions are decoded, a few at a time, so the
+    log-probabilities never cover all positions of all windows at once.
+    Returns the mean loss and the number of scored tokens per second.
+    """
+    model.eval()
+    start_time = time.time()
+    ids = ids.to(device, torch.long)
+    ntargets = ids.size(0) - 1
+    context = min(args.eval_context, ntargets)
+    # The last window is aligned with the end of the stream.
+    begins = list(range(0, ntargets - context, args.eval_stride)) + [ntargets - context]
+    ends = [begin + context for begin in begins]
+    nscored = [ends[0]] + [end - prev_end for prev_end, end in zip(ends, ends[1:])]
+
+    offsets = torch.arange(context + 1, device=device)
+    positions = torch.arange(context, device=device).unsqueeze(1)
+    # Positions decoded at once, so that their log-probabilities take about 64 MB.
+    rows = max(1, (1 << 24) // (eval_batch_size * ntokens))
+    total_loss = 0.
+    with torch.no_grad():
+        for i in range(0, len(begins), eval_batch_size):
+            starts = torch.tensor(begins[i:i + eval_batch_size], device=device)
+            windows = ids[starts.unsqueeze(1) + offsets].t()
+            output = model.features(windows[:-1])
+            # Keep only the last nscored targets of every window (column); the
+            # positions before the longest of them are not decoded at all.
+            batch_nscored = nscored[i:i + eval_batch_size]
+            first = context - max(batch_nscored)
+            batch_nscored = torch.tensor(batch_nscored, device=device)
+            batch_loss = 0.
+            for j in range(first, context, rows):
+                log_probs = model.decode(output[j:j + rows])
+                token_log_probs = log_probs.gather(2, windows[j + 1:j + 1 + rows].unsqueeze(2)).squeeze(2)
+                scored = positions[j:j + rows] >= context - batch_nscored
+                batch_loss -= token_log_probs.masked_select(scored).sum()
+            total_loss += batch_loss.item()
+    return total_loss / ntargets, ntargets / (time.time() - start_time)
+
+
+def train(start_batch=0):
     # Turn on training mode which enables dropout.
     model.train()
     total_loss = 0.
     start_time = time.time()
-    ntokens = len(corpus.dictionary)
     if args.model != 'Transformer':
         hidden = model.init_hidden(args.batch_size)
-    for batch, i in enumerate(range(0, train_data.size(0) - 1, args.bptt)):
-        data, targets = get_batch(train_data, i)
+    batches = timer.timed('data', iterate_batches(train_data, start_batch))
+    for batch, (data, targets) in enumerate(batches, start_batch):
+        if trace is not None:
+            trace.step(batch)
         # Starting each batch, we detach the hidden state from how it was previously produced.
         # If we didn't, the model would try backpropagating all the way to start of the dataset.
-        model.zero_grad()
-        if args.model == 'Transformer':
-            output = model(data)
-            output = output.view(-1, ntokens)
+        with timer.phase('zero_grad'):
+            if flat_params is not None:
+                flat_params.zero_grad()
+            else:
+                model.zero_grad()
+        # Without targets the models return log-probabilities, with them the loss.
+        with timer.phase('forward' if separate_loss else 'forward_loss'):
+            forward_targets = None if separate_loss else targets
+            if args.model == 'Transformer':
+                output = train_model(data, targets=forward_targets)
+            else:
+                hidden = repackage_hidden(hidden)
+                output, hidden = train_model(data, hidden, forward_targets)
+        if separate_loss:
+            with timer.phase('loss'):
+                loss = F.nll_loss(output.view(-1, ntokens), targets)
         else:
-            hidden = repackage_hidden(hidden)
-            output, hidden = model(data, hidden)
-        loss = criterion(output, targets)
-        loss.backward()
+            loss = output
+        with timer.phase('backward'):
+            loss.backward()
 
         # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-        for p in model.parameters():
-            p.data.add_(p.grad, alpha=-lr)
+        with timer.phase('clip'):
+            if flat_params is not None:
+                flat_params.clip_grad_norm_(args.clip)
+            elif args.vocab_parallel:
+                # The norm covers the rows of every rank.
+                vocab_parallel.clip_grad_norm_(model.parameters(), args.clip)
+            elif args.sparse_embedding:
+                clip_grad_norm_(model.parameters(), args.clip)
+            else:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+        with timer.phase('update'):
+            if flat_params is not None:
+                flat_params.sgd_step(lr)
+            else:
+                # A sparse gradient only updates the rows of the tokens in the batch.
+                # Adaptive softmax clusters without targets in the batch have no gradient.
+                for p in model.parameters():
+                    if p.grad is not None:
+                        p.data.add_(p.grad, alpha=-lr)
 
         total_loss += loss.item()
 
+        if args.checkpoint and args.checkpoint_interval and (batch + 1) % args.checkpoint_interval == 0:
+            save_checkpoint(args.checkpoint, epoch, batch + 1)
+
         if batch % args.log_interval == 0 and batch > 0:
             cur_loss = total_loss / args.log_interval
             elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.2f} | ms/batch {:5.2f} | '
-                    'loss {:5.2f} | ppl {:8.2f}'.format(
+            tokens_per_sec = args.log_interval * args.bptt * args.batch_size * data_world_size / elapsed
+            log('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.2f} | ms/batch {:5.2f} | '
+                    'tok/s {:8.0f} | loss {:5.2f} | ppl {:8.2f}'.format(
                 epoch, batch, len(train_data) // args.bptt, lr,
-                elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss)))
+                elapsed * 1000 / args.log_interval, tokens_per_sec, cur_loss, math.exp(cur_loss)))
             total_loss = 0
             start_time = time.time()
         if args.dry_run:
             break
+    if trace is not None:
+        trace.close()
+
+
+def save_profile():
+    if args.profile_json and rank == 0:
+        timer.dump(args.profile_json, model=args.model, emsize=args.emsize, nhid=args.nhid,
+                   nlayers=args.nlayers, bptt=args.bptt, batch_size=args.batch_size,
+                   adaptive=args.adaptive, flat_params=args.flat_params, device=str(device))
 
 
 def export_onnx(path, batch_size, seq_len):
-    print('The model is also exported in ONNX format at {}'.
-          format(os.path.realpath(args.onnx_export)))
-    model.eval()
-    dummy_input = torch.LongTensor(seq_len * batch_size).zero_().view(-1, batch_size).to(device)
-    hidden = model.init_hidden(batch_size)
-    torch.onnx.export(model, (dummy_input, hidden), path)
+    log('The model is also exported in ONNX format at {}'.
+        format(os.path.realpath(args.onnx_export)))
+    onnx_backend.export(model, path, batch_size, seq_len, device)
+
+
+checkpoints = checkpoint.CheckpointWriter()
+
+
+def save_checkpoint(path, next_epoch, next_batch):
+    """Writes the training state in the background; training resumes at batch `next_batch` of `next_epoch`."""
+    if args.vocab_parallel:
+        # All ranks gather the shards, so the checkpoint holds the full vocabulary.
+        state_dict = vocab_parallel.full_state_dict(model)
+    else:
+        state_dict = model.state_dict()
+    if rank != 0:
+        return
+    checkpoints.save({
+        'config': model_config,
+        'vocab': corpus.dictionary.idx2word,
+        'model': checkpoint.snapshot(state_dict),
+        'epoch': next_epoch,
+        'batch': next_batch,
+        'lr': lr,
+        'best_val_loss': best_val_loss,
+        'rng_state': torch.get_rng_state(),
+        'cuda_rng_state': torch.cuda.get_rng_state() if args.cuda else None,
+    }, path)
 
 
 # Loop over epochs.
 lr = args.lr
 best_val_loss = None
+start_epoch, start_batch = 1, 0
+if args.resume:
+    # The RNG states have to stay CPU ByteTensors; load_state_dict copies the weights to the device.
+    state = torch.load(args.resume, map_location='cpu')
+    if state['config'] != model_config:
+        parser.error('the model options do not match the checkpoint {}'.format(state['config']))
+    model.load_state_dict(state['model'])
+    lr, best_val_loss = state['lr'], state['best_val_loss']
+    start_epoch, start_batch = state['epoch'], state['batch']
+    torch.set_rng_state(state['rng_state'])
+    if args.cuda and state.get('cuda_rng_state') is not None:
+        torch.cuda.set_rng_state(state['cuda_rng_state'])
+    log('Resuming from {} at epoch {}, batch {}'.format(args.resume, start_epoch, start_batch))
 
 # At any point you can hit Ctrl + C to break out of training early.
 try:
-    for epoch in range(1, args.epochs+1):
+    for epoch in range(start_epoch, args.epochs+1):
         epoch_start_time = time.time()
-        train()
+        train(start_batch if epoch == start_epoch else 0)
         val_loss = evaluate(val_data)
-        print('-' * 89)
-        print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
-                'valid ppl {:8.2f}'.format(epoch, (time.time() - epoch_start_time),
-                                           val_loss, math.exp(val_loss)))
-        print('-' * 89)
+        log('-' * 89)
+        log('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
+                'valid ppl {:8.2f} | peak mem {:8.1f} MB'.format(epoch, (time.time() - epoch_start_time),
+                                           val_loss, math.exp(val_loss), profiling.peak_memory_mb(device)))
+        log('-' * 89)
+        save_profile()
         # Save the model if the validation loss is the best we've seen so far.
+        # val_loss is reduced over all ranks, so they all take the same branch.
         if not best_val_loss or val_loss < best_val_loss:
-            with open(args.save, 'wb') as f:
-                torch.save(model, f)
             best_val_loss = val_loss
+            save_checkpoint(args.save, epoch + 1, 0)
         else:
             # Anneal the learning rate if no improvement has been seen in the validation dataset.
             lr /= 4.0
+        if args.checkpoint:
+            save_checkpoint(args.checkpoint, epoch + 1, 0)
 except KeyboardInterrupt:
-    print('-' * 89)
-    print('Exiting from training early')
+    log('-' * 89)
+    log('Exiting from training early')
 
 # Load the best saved model.
-with open(args.save, 'rb') as f:
-    model = torch.load(f)
-    # after load the rnn params are not a continuous chunk of memory
-    # this makes them a continuous chunk, and will speed up forward pass
-    # Currently, only rnn model supports flatten_parameters function.
-    if args.model in ['RNN_TANH', 'RNN_RELU', 'LSTM', 'GRU']:
-        model.rnn.flatten_parameters()
+checkpoints.wait()
+if args.distributed:
+    # Wait until rank 0 has written the checkpoint.
+    dist.barrier()
+model.load_state_dict(torch.load(args.save, map_location=device)['model'])
+# Currently, only rnn model supports flatten_parameters function.
+if args.model in ['RNN_TANH', 'RNN_RELU', 'LSTM', 'GRU']:
+    model.rnn.flatten_parameters()
 
 # Run on test data.
+test_start_time = time.time()
 test_loss = evaluate(test_data)
-print('=' * 89)
-print('| End of training | test loss {:5.2f} | test ppl {:8.2f}'.format(
-    test_loss, math.exp(test_loss)))
-print('=' * 89)
-
-if len(args.onnx_export) > 0:
+test_tokens_per_sec = (len(test_data) - 1) * eval_batch_size / (time.time() - test_start_time)
+log('=' * 89)
+log('| End of training | test loss {:5.2f} | test ppl {:8.2f} | {:8.1f} tokens/s'.format(
+    test_loss, math.exp(test_loss), test_tokens_per_sec))
+log('=' * 89)
+
+if args.eval_context:
+    sliding_loss, sliding_tokens_per_sec = evaluate_sliding(corpus.test)
+    log('| Sliding window (context {}, stride {}) | test loss {:5.2f} | test ppl {:8.2f} | {:8.1f} tokens/s'.format(
+        args.eval_context, args.eval_stride, sliding_loss, math.exp(sliding_loss), sliding_tokens_per_sec))
+    log('=' * 89)
+
+if args.quantize == 'dynamic':
+    # Replace the recurrent and linear layers by int8 versions whose activations are quantized on the fly.
+    fp32_model = model
+    model = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+    quant_start_time = time.time()
+    quant_loss = evaluate(test_data)
+    quant_tokens_per_sec = (len(test_data) - 1) * eval_batch_size / (time.time() - quant_start_time)
+    log('| Quantized (dynamic int8) | test loss {:5.2f} | test ppl {:8.2f} | {:8.1f} tokens/s'.format(
+        quant_loss, math.exp(quant_loss), quant_tokens_per_sec))
+    log('| ppl delta {:+8.2f} | speedup {:5.2f}x'.format(
+        math.exp(quant_loss) - math.exp(test_loss), quant_tokens_per_sec / test_tokens_per_sec))
+    log('=' * 89)
+    if args.save_quantized and rank == 0:
+        with open(args.save_quantized, 'wb') as f:
+            torch.save(model, f)
+    model = fp32_model
+
+if len(args.onnx_export) > 0 and rank == 0:
     # Export the model in ONNX format.
     export_onnx(args.onnx_export, batch_size=1, seq_len=args.bptt)
+
+    if args.backend == 'onnxruntime':
+        # The exported graph has dynamic sequence and batch axes, so it runs on the same batches.
+        model = onnx_backend.ORTModel(args.onnx_export, args.threads)
+        ort_start_time = time.time()
+        ort_loss = evaluate(test_data)
+        ort_tokens_per_sec = (len(test_data) - 1) * eval_batch_size / (time.time() - ort_start_time)
+        log('| ONNX Runtime | test loss {:5.2f} | test ppl {:8.2f} | {:8.1f} tokens/s | '
+              'speedup {:5.2f}x over PyTorch'.format(ort_loss, math.exp(ort_loss), ort_tokens_per_sec,
+                                                    ort_tokens_per_sec / test_tokens_per_sec))
+        log('=' * 89)
@@ -1,16 +1,31 @@
+import inspect
 import math
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+
+import vocab_parallel
 
 class RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
-    def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False):
+    def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False,
+                 adaptive_cutoffs=None, token_rank=None, shard_vocab=False, sparse_embedding=False):
         super(RNNModel, self).__init__()
         self.ntoken = ntoken
         self.drop = nn.Dropout(dropout)
-        self.encoder = nn.Embedding(ntoken, ninp)
+        if shard_vocab and adaptive_cutoffs:
+            raise ValueError('The vocabulary can not be sharded with the adaptive softmax')
+        # With shard_vocab, the embedding and decoder rows are split across the distributed ranks.
+        if shard_vocab:
+            self.encoder = vocab_parallel.VocabParallelEmbedding(ntoken, ninp)
+        else:
+            # The dense gradient of a tied decoder would make the embedding's dense
+            # again, so tied models fall back to a dense embedding.
+            self.encoder = nn.Embedding(ntoken, ninp, sparse=sparse_embedding and not tie_weights)
         if rnn_type in ['LSTM', 'GRU']:
             self.rnn = getattr(nn, rnn_type)(ninp, nhid, nlayers, dropout=dropout)
         else:
@@ -20,7 +35,12 @@ class RNNModel(nn.Module):
                 raise ValueError( """An invalid option for `--model` was supplied,
                                  options are ['LSTM', 'GRU', 'RNN_TANH' or 'RNN_RELU']""")
             self.rnn = nn.RNN(ninp, nhid, nlayers, nonlinearity=nonlinearity, dropout=dropout)
-        self.decoder = nn.Linear(nhid, ntoken)
+        if adaptive_cutoffs:
+            self.decoder = AdaptiveDecoder(nhid, ntoken, adaptive_cutoffs, token_rank)
+        elif shard_vocab:
+            self.decoder = vocab_parallel.VocabParallelLinear(nhid, ntoken)
+        else:
+            self.decoder = nn.Linear(nhid, ntoken)
 
         # Optionally tie weights as in:
         # "Using the Output Embedding to Improve Language Models" (Press & Wolf 2016)
@@ -29,6 +49,8 @@ class RNNModel(nn.Module):
         # "Tying Word Vectors and Word Classifiers: A Loss Framework for Language Modeling" (Inan et al. 2016)
         # https://arxiv.org/abs/1611.01462
         if tie_weights:
+            if adaptive_cutoffs:
+                raise ValueError('The tied flag can not be combined with the adaptive softmax')
             if nhid != ninp:
                 raise ValueError('When using the tied flag, nhid must be equal to emsize')
             self.decoder.weight = self.encoder.weight
@@ -41,17 +63,25 @@ class RNNModel(nn.Module):
 
     def init_weights(self):
         initrange = 0.1
+        if isinstance(self.encoder, vocab_parallel.VocabParallelEmbedding):
+            self.encoder.reset_parameters(initrange)
+            self.decoder.reset_parameters(initrange)
+            return
         nn.init.uniform_(self.encoder.weight, -initrange, initrange)
-        nn.init.zeros_(self.decoder.weight)
-        nn.init.uniform_(self.decoder.weight, -initrange, initrange)
+        if not isinstance(self.decoder, AdaptiveDecoder):
+            nn.init.zeros_(self.decoder.weight)
+            nn.init.uniform_(self.decoder.weight, -initrange, initrange)
 
-    def forward(self, input, hidden):
+    def forward(self, input, hidden, targets=None):
+        """Returns the log-probabilities of the next token, or their mean negative
+        log-likelihood if `targets` is given, together with the new hidden state."""
         emb = self.drop(self.encoder(input))
         output, hidden = self.rnn(emb, hidden)
         output = self.drop(output)
-        decoded = self.decoder(output)
-        decoded = decoded.view(-1, self.ntoken)
-        return F.log_softmax(decoded, dim=1), hidden
+        if targets is not None:
+            return _decode(self.decoder, output, targets), hidden
+        decoded = _decode(self.decoder, output)
+        return decoded.view(-1, self.ntoken), hidden
 
     def init_hidden(self, bsz):
         weight = next(self.parameters())
@@ -61,6 +91,71 @@ class RNNModel(nn.Module):
         else:
             return weight.new_zeros(self.nlayers, bsz, self.nhid)
 
+class AdaptiveDecoder(nn.Module):
+    r"""Clustered adaptive softmax output layer over token ids.
+
+    nn.AdaptiveLogSoftmaxWithLoss expects the most frequent classes to have the
+    smallest indices, so token ids are first mapped to their frequency rank.
+    See "Efficient softmax approximation for GPUs" (Grave et al. 2016)
+    https://arxiv.org/abs/1609.04309
+    Args:
+        in_features: the size of the decoder input (required).
+        ntoken: the vocabulary size (required).
+        cutoffs: increasing frequency ranks at which the clusters start (required).
+        token_rank: LongTensor with the frequency rank of every token id (required).
+    """
+
+    def __init__(self, in_features, ntoken, cutoffs, token_rank, div_value=4.0):
+        super(AdaptiveDecoder, self).__init__()
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(in_features, ntoken, list(cutoffs), div_value=div_value)
+        self.register_buffer('token_rank', token_rank.clone())
+
+    def forward(self, input, targets):
+        """Returns the mean negative log-likelihood of `targets` given `input` (N x in_features)."""
+        return self.adaptive(input, self.token_rank[targets]).loss
+
+    def log_prob(self, input):
+        """Returns the log-probabilities of all token ids, in id order."""
+        log_probs = self.adaptive.log_prob(input.reshape(-1, input.size(-1)))
+        log_probs = log_probs.index_select(1, self.token_rank)
+        return log_probs.view(*input.shape[:-1], -1)
+
+
+def _decode(decoder, output, targets=None):
+    """Maps decoder inputs to log-probabilities, or to the mean NLL of `targets`."""
+    if isinstance(decoder, (AdaptiveDecoder, vocab_parallel.VocabParallelLinear)):
+        if targets is not None:
+            return decoder(output.reshape(-1, output.size(-1)), targets)
+        return decoder.log_prob(output)
+    log_probs = F.log_softmax(decoder(output), dim=-1)
+    if targets is not None:
+        return F.nll_loss(log_probs.view(-1, log_probs.size(-1)), targets)
+    return log_probs
+
+def build_model(config, token_rank=None, shard_vocab=False, sparse_embedding=False):
+    """Creates the model described by `config`, the dict stored in checkpoints.
+
+    Without `token_rank`, an adaptive softmax decoder gets a placeholder that
+    is overwritten when the checkpoint's state_dict is loaded. `shard_vocab`
+    splits the vocabulary of an RNN model across the distributed ranks; the
+    checkpoints written from it hold the full vocabulary, so they load either way.
+    `sparse_embedding` only changes the gradient of the embedding, not the state_dict.
+    """
+    cutoffs = config.get('cutoffs')
+    if cutoffs and token_rank is None:
+        token_rank = torch.arange(config['ntokens'])
+    if config['model'] == 'Transformer':
+        return TransformerModel(config['ntokens'], config['emsize'], config['nhead'], config['nhid'],
+                                config['nlayers'], config['dropout'], cutoffs, token_rank, sparse_embedding)
+    return RNNModel(config['model'], config['ntokens'], config['emsize'], config['nhid'], config['nlayers'],
+                    config['dropout'], config['tied'], cutoffs, token_rank, shard_vocab,
+                    sparse_embedding)
+
+# PyTorch 2.x can take the causal mask as a hint and dispatch to the fused
+# scaled-dot-product attention kernels, which never materialize the scores.
+_ENCODER_IS_CAUSAL = 'is_causal' in inspect.signature(nn.TransformerEncoder.forward).parameters
+_LAYER_IS_CAUSAL = 'is_causal' in inspect.signature(nn.TransformerEncoderLayer.forward).parameters
+
 # Temporarily leave PositionalEncoding module here. Will be moved somewhere else.
 class PositionalEncoding(nn.Module):
     r"""Inject some information about the relative or absolute position of the tokens
@@ -91,10 +186,11 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
+    def forward(self, x, offset=0):
         r"""Inputs of forward function
         Args:
             x: the sequence fed to the positional encoder model (required).
+            offset: the position of the first element of x (default=0).
         Shape:
             x: [sequence length, batch size, embed dim]
             output: [sequence length, batch size, embed dim]
@@ -102,13 +198,14 @@ class PositionalEncoding(nn.Module):
             >>> output = pos_encoder(x)
         """
 
-        x = x + self.pe[:x.size(0), :]
+        x = x + self.pe[offset:offset + x.size(0), :]
         return self.dropout(x)
 
 class TransformerModel(nn.Module):
     """Container module with an encoder, a recurrent or transformer module, and a decoder."""
 
-    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, dropout=0.5):
+    def __init__(self, ntoken, ninp, nhead, nhid, nlayers, dropout=0.5,
+                 adaptive_cutoffs=None, token_rank=None, sparse_embedding=False):
         super(TransformerModel, self).__init__()
         try:
             from torch.nn import TransformerEncoder, TransformerEncoderLayer
@@ -116,37 +213,158 @@ class TransformerModel(nn.Module):
             raise ImportError('TransformerEncoder module does not exist in PyTorch 1.1 or lower.')
         self.model_type = 'Transformer'
         self.src_mask = None
+        # Number of encoder layers, from the bottom, whose activations are
+        # recomputed during backward instead of being kept.
+        self.checkpoint_layers = 0
         self.pos_encoder = PositionalEncoding(ninp, dropout)
         encoder_layers = TransformerEncoderLayer(ninp, nhead, nhid, dropout)
         self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
-        self.encoder = nn.Embedding(ntoken, ninp)
+        # With sparse_embedding, the gradient only holds the rows of the tokens in the batch.
+        self.encoder = nn.Embedding(ntoken, ninp, sparse=sparse_embedding)
         self.ninp = ninp
-        self.decoder = nn.Linear(ninp, ntoken)
+        if adaptive_cutoffs:
+            self.decoder = AdaptiveDecoder(ninp, ntoken, adaptive_cutoffs, token_rank)
+        else:
+            self.decoder = nn.Linear(ninp, ntoken)
 
         self.init_weights()
 
-    def _generate_square_subsequent_mask(self, sz):
-        mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
+    def _generate_square_subsequent_mask(self, sz, device=None, dtype=torch.float):
+        return torch.full((sz, sz), float('-inf'), device=device, dtype=dtype).triu(1)
+
+    def _causal_mask(self, sz, device, dtype=torch.float):
+        """Returns the causal mask for `sz` positions, built on `device` and cached per (sz, device, dtype)."""
+        # Models pickled before the cache existed do not have the attribute.
+        masks = self.__dict__.setdefault('_masks', OrderedDict())
+        key = (sz, device, dtype)
+        if key in masks:
+            masks.move_to_end(key)
+        else:
+            masks[key] = self._generate_square_subsequent_mask(sz, device, dtype)
+            # The final short batch adds one more length; keep only a few.
+            while len(masks) > 4:
+                masks.popitem(last=False)
+        return masks[key]
+
+    def _encode(self, src):
+        mask = self.src_mask
+        if mask is not None and _ENCODER_IS_CAUSAL and not torch.jit.is_tracing():
+            return self.transformer_encoder(src, mask, is_causal=True)
+        return self.transformer_encoder(src, mask)
 
     def init_weights(self):
         initrange = 0.1
         nn.init.uniform_(self.encoder.weight, -initrange, initrange)
-        nn.init.zeros_(self.decoder.weight)
-        nn.init.uniform_(self.decoder.weight, -initrange, initrange)
-
-    def forward(self, src, has_mask=True):
-        if has_mask:
-            device = src.device
-            if self.src_mask is None or self.src_mask.size(0) != len(src):
-                mask = self._generate_square_subsequent_mask(len(src)).to(device)
-                self.src_mask = mask
-        else:
+        if not isinstance(self.decoder, AdaptiveDecoder):
+            nn.init.zeros_(self.decoder.weight)
+            nn.init.uniform_(self.decoder.weight, -initrange, initrange)
+
+    def forward(self, src, has_mask=True, targets=None):
+        """Returns the log-probabilities of the next token at every position, or
+        their mean negative log-likelihood if `targets` is given."""
+        return self.decode(self.features(src, has_mask), targets)
+
+    def features(self, src, has_mask=True):
+        """Returns the encoder output that `decode` maps to log-probabilities."""
+        if not has_mask:
             self.src_mask = None
+        elif torch.jit.is_tracing():
+            # When exporting, the mask is built from the traced size so the sequence axis stays dynamic.
+            self.src_mask = self._generate_square_subsequent_mask(src.size(0), src.device)
+        else:
+            self.src_mask = self._causal_mask(src.size(0), src.device)
 
         src = self.encoder(src) * math.sqrt(self.ninp)
         src = self.pos_encoder(src)
-        output = self.transformer_encoder(src, self.src_mask)
-        output = self.decoder(output)
-        return F.log_softmax(output, dim=-1)
+        if getattr(self, 'checkpoint_layers', 0) > 0 and self.training and torch.is_grad_enabled():
+            return self._checkpointed_encoder(src)
+        return self._encode(src)
+
+    def decode(self, output, targets=None):
+        """Maps encoder outputs to log-probabilities, or to the mean NLL of `targets`."""
+        return _decode(self.decoder, output, targets)
+
+    def _checkpointed_encoder(self, src):
+        output = src
+        kwargs = {'is_causal': True} if self.src_mask is not None and _LAYER_IS_CAUSAL else {}
+        for i, layer in enumerate(self.transformer_encoder.layers):
+            if i < self.checkpoint_layers:
+                # The RNG state is restored for the recomputation, so dropout masks match.
+                output = torch.utils.checkpoint.checkpoint(layer, output, self.src_mask, use_reentrant=False,
+                                                           **kwargs)
+            else:
+                output = layer(output, self.src_mask, **kwargs)
+        if self.transformer_encoder.norm is not None:
+            output = self.transformer_encoder.norm(output)
+        return output
+
+    def init_cache(self):
+        """Returns an empty per-layer key/value cache for `forward_incremental`."""
+        return [None] * len(self.transformer_encoder.layers)
+
+    def forward_incremental(self, src, cache):
+        """Runs the encoder over the new positions in `src` only.
+
+        The keys and values of the previous positions are taken from `cache`, so
+        the result equals the last len(src) positions of `forward` applied to the
+        whole prefix. Returns the log-probabilities of the new positions and the
+        updated cache.
+        """
+        offset = 0 if cache[0] is None else cache[0][0].size(0)
+        src = self.encoder(src) * math.sqrt(self.ninp)
+        output = self.pos_encoder(src, offset)
+        new_cache = []
+        for layer, layer_cache in zip(self.transformer_encoder.layers, cache):
+            output, layer_cache = _encoder_layer_step(layer, output, layer_cache)
+            new_cache.append(layer_cache)
+        if self.transformer_encoder.norm is not None:
+            output = self.transformer_encoder.norm(output)
+        return _decode(self.decoder, output), new_cache
+
+
+def _cached_self_attention(attn, x, cache):
+    """Causal multi-head self-attention of the new positions `x` over the cached and new keys."""
+    new_len, bsz, embed_dim = x.size()
+    head_dim = embed_dim // attn.num_heads
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+    if cache is not None:
+        k = torch.cat([cache[0], k])
+        v = torch.cat([cache[1], v])
+    total_len = k.size(0)
+
+    q = q.reshape(new_len, bsz * attn.num_heads, head_dim).transpose(0, 1)
+    keys = k.reshape(total_len, bsz * attn.num_heads, head_dim).transpose(0, 1)
+    values = v.reshape(total_len, bsz * attn.num_heads, head_dim).transpose(0, 1)
+    # The i-th new position sits at total_len - new_len + i and must not see later ones.
+    future = None
+    if new_len > 1:
+        future = torch.ones(new_len, total_len, dtype=torch.bool, device=x.device).triu(total_len - new_len + 1)
+    dropout = attn.dropout if attn.training else 0.0
+    if hasattr(F, 'scaled_dot_product_attention'):
+        if new_len == total_len:
+            output = F.scaled_dot_product_attention(q, keys, values, dropout_p=dropout, is_causal=new_len > 1)
+        else:
+            allowed = None if future is None else ~future
+            output = F.scaled_dot_product_attention(q, keys, values, attn_mask=allowed, dropout_p=dropout)
+    else:
+        scores = torch.bmm(q * head_dim ** -0.5, keys.transpose(1, 2))
+        if future is not None:
+            scores = scores.masked_fill(future, float('-inf'))
+        weights = F.dropout(F.softmax(scores, dim=-1), dropout, attn.training)
+        output = torch.bmm(weights, values)
+    output = output.transpose(0, 1).reshape(new_len, bsz, embed_dim)
+    return attn.out_proj(output), (k, v)
+
+
+def _encoder_layer_step(layer, x, cache):
+    """Applies a TransformerEncoderLayer to the new positions `x`, mirroring its forward."""
+    activation = getattr(layer, 'activation', F.relu)
+    if getattr(layer, 'norm_first', False):
+        attn_output, cache = _cached_self_attention(layer.self_attn, layer.norm1(x), cache)
+        x = x + layer.dropout1(attn_output)
+        x = x + layer.dropout2(layer.linear2(layer.dropout(activation(layer.linear1(layer.norm2(x))))))
+    else:
+        attn_output, cache = _cached_self_attention(layer.self_attn, x, cache)
+        x = layer.norm1(x + layer.dropout1(attn_output))
+        x = layer.norm2(x + layer.dropout2(layer.linear2(layer.dropout(activation(layer.linear1(x))))))
+    return x, cache
@@ -0,0 +1,79 @@
+import torch
+import torch.nn.functional as F
+
+
+def export(model, path, batch_size, seq_len, device):
+    """Exports RNNModel or TransformerModel to ONNX with dynamic sequence and batch axes."""
+    model.eval()
+    dummy_input = torch.zeros(seq_len, batch_size, dtype=torch.long, device=device)
+    if getattr(model, 'model_type', None) == 'Transformer':
+        args = (dummy_input,)
+        input_names, output_names = ['input'], ['output']
+        dynamic_axes = {'input': {0: 'seq', 1: 'batch'}, 'output': {0: 'seq', 1: 'batch'}}
+    else:
+        hidden = model.init_hidden(batch_size)
+        args = (dummy_input, hidden)
+        if model.rnn_type == 'LSTM':
+            input_names, output_names = ['input', 'h0', 'c0'], ['output', 'hn', 'cn']
+        else:
+            input_names, output_names = ['input', 'h0'], ['output', 'hn']
+        # The RNN output is flattened to (seq * batch) x ntokens.
+        dynamic_axes = {'input': {0: 'seq', 1: 'batch'}, 'output': {0: 'tokens'}}
+        for name in input_names[1:] + output_names[1:]:
+            dynamic_axes[name] = {1: 'batch'}
+    with torch.no_grad():
+        torch.onnx.export(model, args, path, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=14)
+
+
+class ORTModel(object):
+    """Runs a model exported by `export` with ONNX Runtime on CPU.
+
+    It mirrors the calls that main.py and generate.py make on the PyTorch
+    models, so either can be passed to `evaluate` or used for sampling. The
+    session is created once and reused for every call.
+    """
+
+    def __init__(self, path, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        inputs = self.session.get_inputs()
+        self.hidden_names = [i.name for i in inputs[1:]]
+        self.model_type = 'Transformer' if not self.hidden_names else 'RNN'
+        if self.hidden_names:
+            self.nlayers, _, self.nhid = inputs[1].shape
+
+    def eval(self):
+        return self
+
+    def init_hidden(self, bsz):
+        hidden = tuple(torch.zeros(self.nlayers, bsz, self.nhid) for _ in self.hidden_names)
+        return hidden if len(hidden) > 1 else hidden[0]
+
+    def __call__(self, input, hidden=None, targets=None):
+        feeds = {'input': input.cpu().numpy()}
+        if self.hidden_names:
+            states = hidden if isinstance(hidden, tuple) else (hidden,)
+            for name, state in zip(self.hidden_names, states):
+                feeds[name] = state.cpu().numpy()
+        outputs = [torch.from_numpy(output) for output in self.session.run(None, feeds)]
+        output = outputs[0]
+        if targets is not None:
+            output = F.nll_loss(output.view(-1, output.size(-1)), targets.cpu())
+        if not self.hidden_names:
+            return output
+        hidden = tuple(outputs[1:]) if len(outputs) > 2 else outputs[1]
+        return output, hidden
+
+    def init_cache(self):
+        return None
+
+    def forward_incremental(self, src, cache):
+        # The exported graph has no key/value inputs, so the whole prefix is rerun;
+        # the "cache" is the prefix itself.
+        prefix = src if cache is None else torch.cat([cache, src])
+        return self(prefix)[-src.size(0):], prefix
@@ -0,0 +1,121 @@
+import contextlib
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module.
+    resource = None
+
+
+def peak_memory_mb(device):
+    """Peak memory so far: allocated tensor memory on CUDA, resident set size of the process on CPU.
+
+    On Windows the peak working set is read with psutil, if it is installed;
+    otherwise the result is NaN.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 1024
+    try:
+        import psutil
+    except ImportError:
+        return float('nan')
+    return getattr(psutil.Process().memory_info(), 'peak_wset', float('nan')) / 2 ** 20
+
+
+class PhaseTimer(object):
+    """Accumulates wall-clock time per named phase of the training step.
+
+    On CUDA the device is synchronized around every phase so that the time of
+    asynchronous kernels is charged to the phase that launched them. A disabled
+    timer adds no synchronization.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.enabled = enabled
+        self.sync = device.type == 'cuda'
+        self.totals = OrderedDict()
+        self.counts = OrderedDict()
+
+    def phase(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed_phase(name)
+
+    @contextlib.contextmanager
+    def _timed_phase(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def timed(self, name, iterable):
+        """Yields from `iterable`, charging the time spent in each next() to `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        phases = OrderedDict()
+        for name, total in self.totals.items():
+            phases[name] = {'count': self.counts[name],
+                            'total_ms': total * 1000,
+                            'mean_ms': total * 1000 / self.counts[name]}
+        return phases
+
+    def dump(self, path, **config):
+        """Writes the per-phase aggregates, together with `config`, as JSON to `path`."""
+        with open(path, 'w') as f:
+            json.dump({'config': config, 'phases': self.summary()}, f, indent=2)
+
+
+class TraceWindow(object):
+    """Records a torch.profiler trace of batches [start, start + length) and saves it
+    as a Chrome trace to `path`."""
+
+    def __init__(self, path, start, length, device):
+        self.path = path
+        self.start = start
+        self.length = length
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+        self.done = False
+
+    def step(self, batch):
+        """Called at the start of every batch."""
+        if self.done:
+            return
+        if self.profiler is None and batch == self.start:
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True)
+            self.profiler.__enter__()
+        elif self.profiler is not None and batch == self.start + self.length:
+            self.close()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.path)
+            print('Saved profiler trace of batches {}-{} to {}'.format(
+                self.start, self.start + self.length - 1, self.path))
+            self.profiler = None
+            self.done = True
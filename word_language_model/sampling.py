@@ -0,0 +1,92 @@
+import queue
+import threading
+
+import torch
+
+
+def sample(logprobs, temperature=1.0, top_k=0, top_p=1.0, generator=None):
+    """Draws one token id per row of `logprobs` (batch x ntokens).
+
+    Temperature, top-k and nucleus (top-p) filtering are applied in log-space
+    and the draw uses the Gumbel-max trick, so everything stays on the device
+    of `logprobs` and no host synchronization is needed. `generator` is a
+    torch.Generator, or a list with one per row, so that every row draws from
+    its own random stream.
+    """
+    logits = logprobs / temperature
+    if 0 < top_k < logits.size(-1):
+        kth = torch.topk(logits, top_k, dim=-1)[0][..., -1:]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    if top_p < 1.0:
+        sorted_logits, order = torch.sort(logits, dim=-1, descending=True)
+        probs = sorted_logits.softmax(dim=-1)
+        # Drop a token once the tokens ranked above it already cover top_p;
+        # the most likely token is always kept.
+        drop = probs.cumsum(dim=-1) - probs >= top_p
+        logits = logits.scatter(-1, order, sorted_logits.masked_fill(drop, float('-inf')))
+    noise = torch.empty_like(logits)
+    if isinstance(generator, (list, tuple)):
+        for row, row_generator in zip(noise, generator):
+            row.exponential_(generator=row_generator)
+    else:
+        noise.exponential_(generator=generator)
+    gumbel = -noise.log()
+    return (logits + gumbel).argmax(dim=-1)
+
+
+class TokenWriter(object):
+    """Writes sampled ids as words, one output file per stream.
+
+    Ids are appended as device tensors and copied to the host in blocks of
+    `block_size` steps; the conversion to words and the file writes happen on a
+    background thread so the sampling loop never waits on them.
+    """
+
+    def __init__(self, outfs, idx2word, block_size=128, words_per_line=20):
+        self.outfs = outfs
+        self.idx2word = idx2word
+        self.block_size = block_size
+        self.words_per_line = words_per_line
+        self.buffer = []
+        self.written = 0
+        self.queue = queue.Queue(maxsize=4)
+        self.thread = threading.Thread(target=self._write_blocks, daemon=True)
+        self.thread.start()
+
+    def append(self, ids):
+        self.buffer.append(ids)
+        if len(self.buffer) == self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        block = torch.stack(self.buffer)
+        self.buffer = []
+        event = None
+        if block.is_cuda:
+            block = block.to('cpu', non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((block, event))
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for outf in self.outfs:
+            outf.close()
+
+    def _write_blocks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            block, event = item
+            if event is not None:
+                event.synchronize()
+            for row in block.tolist():
+                sep = '\n' if self.written % self.words_per_line == self.words_per_line - 1 else ' '
+                for outf, idx in zip(self.outfs, row):
+                    outf.write(self.idx2word[idx] + sep)
+                self.written += 1
@@ -0,0 +1,228 @@
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+
+import clipping
+
+
+def shard_range(ntoken, rank, world_size):
+    """Returns the [start, end) token ids held by `rank`; shard sizes differ by at most one."""
+    return rank * ntoken // world_size, (rank + 1) * ntoken // world_size
+
+
+def _rank_and_size(group):
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(group), dist.get_world_size(group)
+    return 0, 1
+
+
+class _ReduceFromShards(torch.autograd.Function):
+    """Sums the partial outputs of all shards. Every rank uses the sum in the
+    same way, so the gradient passes through unchanged."""
+
+    @staticmethod
+    def forward(ctx, input, group):
+        output = input.clone()
+        dist.all_reduce(output, group=group)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
+class _CopyToShards(torch.autograd.Function):
+    """Passes the replicated input to every shard; each shard contributes
+    part of its gradient, so the gradients are summed in backward."""
+
+    @staticmethod
+    def forward(ctx, input, group):
+        ctx.group = group
+        return input.view_as(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_input = grad_output.clone()
+        dist.all_reduce(grad_input, group=ctx.group)
+        return grad_input, None
+
+
+class _ShardedNLLLoss(torch.autograd.Function):
+    """Mean negative log-likelihood of `targets` given logits split by vocabulary rows.
+
+    Only the per-token maximum, the sum of exponentials and the target logit
+    are reduced across shards, three vectors of N values, so the full N x ntoken
+    logits are never gathered.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, targets, vocab_start, group):
+        logits_max = logits.max(dim=1)[0]
+        dist.all_reduce(logits_max, op=dist.ReduceOp.MAX, group=group)
+        exp_logits = (logits - logits_max.unsqueeze(1)).exp_()
+        sum_exp = exp_logits.sum(dim=1)
+        dist.all_reduce(sum_exp, group=group)
+
+        local_targets = targets - vocab_start
+        outside = (local_targets < 0) | (local_targets >= logits.size(1))
+        local_targets = local_targets.masked_fill(outside, 0)
+        target_logits = logits.gather(1, local_targets.unsqueeze(1)).squeeze(1) - logits_max
+        target_logits = target_logits.masked_fill(outside, 0.)
+        dist.all_reduce(target_logits, group=group)
+
+        softmax = exp_logits.div_(sum_exp.unsqueeze(1))
+        ctx.save_for_backward(softmax, local_targets, outside)
+        return (sum_exp.log() - target_logits).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        softmax, local_targets, outside = ctx.saved_tensors
+        # d loss / d logits = (softmax - one_hot(target)) / N, restricted to the local rows.
+        grad_logits = softmax.clone()
+        grad_logits.scatter_add_(1, local_targets.unsqueeze(1), (outside.to(softmax.dtype) - 1).unsqueeze(1))
+        grad_logits.mul_(grad_output / softmax.size(0))
+        return grad_logits, None, None, None
+
+
+def _gather_rows(tensor, ntoken, group):
+    """Concatenates the row shards of `tensor` from all ranks into ntoken rows."""
+    rank, world_size = _rank_and_size(group)
+    if world_size == 1:
+        return tensor
+    # all_gather needs equal sizes, so every shard is padded to the largest one.
+    rows = -(-ntoken // world_size)
+    padded = tensor.new_zeros((rows,) + tensor.shape[1:])
+    padded[:tensor.size(0)] = tensor
+    shards = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(shards, padded, group=group)
+    return torch.cat([shard[:end - start] for shard, (start, end) in
+                      zip(shards, (shard_range(ntoken, r, world_size) for r in range(world_size)))])
+
+
+class _VocabShard(nn.Module):
+    """Base of the layers that keep the rows [vocab_start, vocab_end) of an ntoken-row weight."""
+
+    def __init__(self, ntoken, group=None):
+        super(_VocabShard, self).__init__()
+        self.ntoken = ntoken
+        self.group = group
+        rank, world_size = _rank_and_size(group)
+        if ntoken < world_size:
+            raise ValueError('The vocabulary is smaller than the number of shards')
+        self.vocab_start, self.vocab_end = shard_range(ntoken, rank, world_size)
+        # The rows differ between ranks, so they are initialized from a per-rank stream.
+        # Every rank draws the same seed, which keeps the global generator, and with it
+        # the initialization and dropout of the replicated layers, in step.
+        seed = int(torch.randint(2 ** 62, ()))
+        self.generator = torch.Generator().manual_seed(seed + rank)
+
+    def _shard_parameter(self, *shape):
+        param = nn.Parameter(torch.empty(self.vocab_end - self.vocab_start, *shape))
+        # Tells clip_grad_norm_ and full_state_dict that the parameter is split across ranks.
+        param.vocab_parallel = True
+        return param
+
+    def _uniform_(self, param, bound):
+        with torch.no_grad():
+            param.copy_(torch.empty(param.shape).uniform_(-bound, bound, generator=self.generator))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints hold the full vocabulary; keep only the local rows.
+        for name, param in self._parameters.items():
+            key = prefix + name
+            if key in state_dict and state_dict[key].size(0) == self.ntoken != param.size(0):
+                state_dict[key] = state_dict[key][self.vocab_start:self.vocab_end]
+        super(_VocabShard, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class VocabParallelEmbedding(_VocabShard):
+    r"""nn.Embedding whose rows are split across the ranks of `group`.
+
+    Every rank looks up the ids that fall into its rows, zeros the others and
+    the partial embeddings are summed, so all ranks get the full embedding of
+    the (replicated) input.
+    """
+
+    def __init__(self, ntoken, embedding_dim, group=None):
+        super(VocabParallelEmbedding, self).__init__(ntoken, group)
+        self.weight = self._shard_parameter(embedding_dim)
+        self.reset_parameters(1.0)
+
+    def reset_parameters(self, bound):
+        self._uniform_(self.weight, bound)
+
+    def forward(self, input):
+        local = input - self.vocab_start
+        outside = (local < 0) | (local >= self.weight.size(0))
+        emb = F.embedding(local.masked_fill(outside, 0), self.weight)
+        emb = emb.masked_fill(outside.unsqueeze(-1), 0.)
+        return _ReduceFromShards.apply(emb, self.group)
+
+
+class VocabParallelLinear(_VocabShard):
+    r"""Decoder nn.Linear(in_features, ntoken) whose output rows are split across the ranks of `group`.
+
+    Like AdaptiveDecoder, `forward` takes the targets and returns the mean
+    negative log-likelihood, computed with a distributed log-softmax over the
+    local logits. `log_prob` gathers the full log-probabilities, for generation
+    and scoring.
+    """
+
+    def __init__(self, in_features, ntoken, group=None):
+        super(VocabParallelLinear, self).__init__(ntoken, group)
+        self.weight = self._shard_parameter(in_features)
+        self.bias = self._shard_parameter()
+        # Same bias initialization as nn.Linear.
+        self._uniform_(self.bias, in_features ** -0.5)
+
+    def reset_parameters(self, bound):
+        self._uniform_(self.weight, bound)
+
+    def _local_logits(self, input):
+        input = _CopyToShards.apply(input.reshape(-1, input.size(-1)), self.group)
+        return F.linear(input, self.weight, self.bias)
+
+    def forward(self, input, targets):
+        """Returns the mean negative log-likelihood of `targets` given `input` (N x in_features)."""
+        return _ShardedNLLLoss.apply(self._local_logits(input), targets, self.vocab_start, self.group)
+
+    def log_prob(self, input):
+        """Returns the log-probabilities of all token ids; every rank has to call it."""
+        logits = _gather_rows(self._local_logits(input).t(), self.ntoken, self.group).t()
+        return F.log_softmax(logits, dim=-1).view(*input.shape[:-1], -1)
+
+
+def clip_grad_norm_(parameters, max_norm, group=None):
+    """torch.nn.utils.clip_grad_norm_ for a model with vocabulary-sharded parameters.
+
+    The squared norms of the sharded gradients are summed over all ranks and
+    those of the replicated ones, which are equal on every rank, are counted
+    once, so every rank computes the norm of the whole model and scales by the
+    same factor.
+    """
+    params = [p for p in parameters if p.grad is not None]
+    # Every rank has to take part in the all-reduce, even without sharded gradients.
+    sharded = [params[0].grad.new_zeros(())]
+    replicated = []
+    for p in params:
+        (sharded if getattr(p, 'vocab_parallel', False) else replicated).append(clipping.grad_squared_norm(p))
+    total_norm, clip_coef = clipping.clip_coef(replicated, max_norm, sharded, group)
+    for p in params:
+        p.grad.mul_(clip_coef)
+    return total_norm
+
+
+def full_state_dict(model):
+    """Returns the state_dict of `model` with every sharded tensor gathered to the
+    full vocabulary, as an unsharded model would save it. Every rank has to call it."""
+    state = model.state_dict()
+    gathered = {}
+    for prefix, module in model.named_modules():
+        if isinstance(module, _VocabShard):
+            for name, param in module.named_parameters(recurse=False):
+                # Tied weights are gathered once.
+                if id(param) not in gathered:
+                    gathered[id(param)] = _gather_rows(param.detach(), module.ntoken, module.group)
+                state[prefix + '.' + name if prefix else name] = gathered[id(param)]
+    return state